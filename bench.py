@@ -0,0 +1,253 @@
+# === Offline load test / benchmark for bot.py ===
+# Builds the real Application (same handlers as main()) on top of a fake Bot API
+# transport and replays synthetic traffic against a throwaway bot.db.
+#
+#   python bench.py --users 2000 --latency-ms 30 --error-rate 0.01
+#
+# Reports throughput, p50/p99 latency per handler, DB statements per update,
+# Bot API calls per method and peak memory. No token or network needed.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Optional, Tuple
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+import bot
+
+try:
+    import resource
+except ImportError:  # not available on every platform
+    resource = None
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+ADMIN_ID = 1
+
+# ========= FAKE BOT API =========
+class FakeBotAPI(BaseRequest):
+    """Stand-in for api.telegram.org: records calls, adds latency, injects 429s."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")}
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            return self._message(params)
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "U"}}
+        if method == "getUpdates":
+            return []
+        return True
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if api_method not in ("getMe", "getUpdates") and random.random() < self.error_rate:
+            self.errors[api_method] += 1
+            body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1}}
+            return 429, json.dumps(body).encode()
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+# ========= SYNTHETIC UPDATES =========
+class UpdateFactory:
+    def __init__(self):
+        self._next_id = 0
+
+    def _id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    @staticmethod
+    def _user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}"}
+
+    def text(self, uid: int, text: str) -> dict:
+        msg = {"message_id": self._id(), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+               "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._id(), "message": msg}
+
+    def callback(self, uid: int, data: str) -> dict:
+        msg = {"message_id": self._id(), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+               "from": BOT_USER, "text": "menu"}
+        return {"update_id": self._id(),
+                "callback_query": {"id": str(self._id()), "from": self._user(uid), "chat_instance": str(uid),
+                                   "data": data, "message": msg}}
+
+def user_session(f: UpdateFactory, uid: int, referrer: Optional[int]) -> list:
+    """Typical user: /start (maybe referred), bonus, join check, withdraw."""
+    start = f"/start {referrer}" if referrer else "/start"
+    return [f.text(uid, start), f.callback(uid, "user:bonus"), f.callback(uid, "user:reflink"),
+            f.callback(uid, "user:joinedcheck"), f.callback(uid, "user:bonus"),
+            f.callback(uid, "user:withdraw"), f.text(uid, f"{random.randint(100, 1500)} acct-{uid}"),
+            f.text(uid, "hi")]
+
+def admin_session(f: UpdateFactory) -> list:
+    return [f.text(ADMIN_ID, "/claimadmin " + bot.OWNER_CLAIM_PIN), f.text(ADMIN_ID, "/admin"),
+            f.callback(ADMIN_ID, "admin:broadcast"), f.text(ADMIN_ID, "Benchmark *broadcast*")]
+
+# ========= MEASUREMENT =========
+def label_for(update: Update, context) -> str:
+    if update.callback_query:
+        return update.callback_query.data
+    text = (update.message.text or "") if update.message else ""
+    if text.startswith("/"):
+        return text.split()[0]
+    mode = (context.user_data or {}).get("await")
+    return f"text:{mode[0]}" if mode else "text"
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+class Recorder:
+    def __init__(self):
+        self.started = {}
+        self.latencies = defaultdict(list)
+        self.waiters = {}
+        self.handler_errors = Counter()
+        self.statements = 0
+
+    async def on_begin(self, update: Update, context):
+        self.started[update.update_id] = (time.perf_counter(), label_for(update, context))
+
+    async def on_end(self, update: Update, context):
+        t0, label = self.started.pop(update.update_id)
+        self.latencies[label].append(time.perf_counter() - t0)
+        fut = self.waiters.pop(update.update_id, None)
+        if fut and not fut.done():
+            fut.set_result(None)
+
+    async def on_error(self, update, context):
+        self.handler_errors[type(context.error).__name__] += 1
+
+    def on_statement(self, sql: str):
+        head = sql.lstrip()[:8].upper()
+        if not head.startswith(("BEGIN", "COMMIT", "SAVEPOIN", "RELEASE", "ROLLBACK", "PRAGMA")):
+            self.statements += 1
+
+# ========= RUN =========
+async def run(args):
+    tmp = tempfile.mkdtemp(prefix="botbench-")
+    bot.DB.path = os.path.join(tmp, "bot.db")
+    bot.init_db()
+    bot.BULK_BUCKET.rate = bot.BULK_BUCKET.capacity = args.broadcast_rate
+    bot.OUT_RATE = args.api_rate
+    bot.OUT_CHAT_RATE = bot.OUT_CHAT_BURST = args.chat_rate
+    await bot.set_setting("channels", json.dumps([f"@bench{i}" for i in range(args.channels)]))
+    await bot.set_setting("daily_bonus_amount", "1000")
+    await bot.set_setting("min_withdraw", "100")
+
+    api = FakeBotAPI(latency=args.latency_ms / 1000.0, error_rate=args.error_rate)
+    rec = Recorder()
+    bot.DB.set_trace_callback(rec.on_statement)
+    app = bot.build_application("1000:BENCH", request=api)
+    app.add_handler(TypeHandler(Update, rec.on_begin), group=-100)
+    app.add_handler(TypeHandler(Update, rec.on_end), group=100)
+    app.add_error_handler(rec.on_error)
+    await app.initialize()
+    await app.start()
+
+    async def feed(updates: list):
+        for raw in updates:
+            update = Update.de_json(raw, app.bot)
+            fut = asyncio.get_running_loop().create_future()
+            rec.waiters[update.update_id] = fut
+            await app.update_queue.put(update)
+            await fut
+
+    f = UpdateFactory()
+    sessions = [admin_session(f)]
+    for uid in range(2, args.users + 2):
+        referrer = random.randint(2, uid - 1) if uid > 2 and random.random() < args.referral_rate else None
+        sessions.append(user_session(f, uid, referrer))
+    total = sum(len(s) for s in sessions)
+
+    sem = asyncio.Semaphore(args.sessions)
+
+    async def session(updates: list):
+        async with sem:
+            await feed(updates)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(session(s) for s in sessions))
+    elapsed = time.perf_counter() - t0
+    statements = rec.statements
+
+    t1 = time.perf_counter()
+    while bot._BROADCASTS:
+        await asyncio.sleep(0.05)
+    broadcast_time = time.perf_counter() - t1
+
+    await app.stop()
+    await bot.WRITER.close()
+    await app.shutdown()
+    bot.DB.close()
+
+    print(f"updates: {total} in {elapsed:.2f}s -> {total / elapsed:,.0f} updates/s")
+    print(f"db statements/update: {statements / total:.2f}")
+    print(f"{'handler':<24}{'n':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, vals in sorted(rec.latencies.items()):
+        print(f"{label:<24}{len(vals):>7}{percentile(vals, 50) * 1000:>10.2f}{percentile(vals, 99) * 1000:>10.2f}")
+    print("bot api calls: " + ", ".join(f"{k}={v}" for k, v in sorted(api.calls.items())))
+    if api.errors:
+        print("injected errors: " + ", ".join(f"{k}={v}" for k, v in sorted(api.errors.items())))
+    if rec.handler_errors:
+        print("handler errors: " + ", ".join(f"{k}={v}" for k, v in sorted(rec.handler_errors.items())))
+    print(f"broadcast drain after load: {broadcast_time:.2f}s")
+    if resource is not None:
+        print(f"peak rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+def main():
+    p = argparse.ArgumentParser(description="Replay synthetic traffic against bot.py with a fake Bot API.")
+    p.add_argument("--users", type=int, default=1000, help="number of simulated users")
+    p.add_argument("--sessions", type=int, default=200, help="users active at the same time")
+    p.add_argument("--channels", type=int, default=3, help="required channels for the join check")
+    p.add_argument("--referral-rate", type=float, default=0.5, help="share of users arriving via a referral")
+    p.add_argument("--latency-ms", type=float, default=20.0, help="mean fake Bot API latency")
+    p.add_argument("--error-rate", type=float, default=0.0, help="share of Bot API calls answered with 429")
+    p.add_argument("--broadcast-rate", type=float, default=1000.0, help="broadcast token bucket rate (msg/s)")
+    p.add_argument("--api-rate", type=float, default=5000.0, help="outbound scheduler global rate (calls/s)")
+    p.add_argument("--chat-rate", type=float, default=1000.0, help="outbound scheduler per-chat rate (msg/s)")
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
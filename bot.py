@@ -13,20 +13,42 @@
 # - For Join-Check to work, add your bot as ADMIN to each channel you set.
 # - Referral bonus triggers once when a referred user passes the join-check for the first time.
 # - All settings are editable from the Admin Panel.
+# - Several bots can share one process: python bot.py bots.json (see MULTI-BOT RUNNER).
 
 import asyncio
+import contextvars
+import csv
+import gzip
+import heapq
+import io
 import json
+import math
+import os
+import queue
+import signal
 import sqlite3
-from datetime import datetime, timedelta
-from typing import List, Optional
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from typing import Callable, Optional, Tuple
 
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
 from telegram.ext import (
-    ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler,
-    CallbackQueryHandler, filters
+    Application, ApplicationBuilder, ApplicationHandlerStop, BasePersistence, BaseRateLimiter,
+    CallbackContext, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler,
+    PersistenceInput, TypeHandler, filters
 )
 
 # ========= CONFIG =========
@@ -34,6 +56,27 @@ TOKEN = "8073458119:AAHOAjdwxh_Bv8wJLRZaf6l89-nZVrUTncY"  # <-- REPLACE with you
 OWNER_CLAIM_PIN = "1234"             # <-- Change this to your secret PIN for /claimadmin
 DB_PATH = "bot.db"
 
+# Serving mode: leave WEBHOOK_URL empty to use long polling.
+WEBHOOK_URL = ""                     # public base URL Telegram posts to, e.g. "https://bot.example.com"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_SECRET = ""                  # sent by Telegram in X-Telegram-Bot-Api-Secret-Token
+MAX_CONCURRENT_UPDATES = 64          # updates processed at once (same-user updates still run in order)
+
+# Metrics: Prometheus text on http://METRICS_HOST:METRICS_PORT/ (port 0 = no endpoint; /stats still works)
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+
+# Retention: processed withdrawals older than this move to the archive table
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_DB = ""                      # optional separate file for the archive, e.g. "archive.db"
+
+# Several bots in one process: a JSON list of {"name", "token", "db"} (see MULTI-BOT RUNNER).
+# Also accepted as the first command-line argument: python bot.py bots.json
+BOTS_FILE = ""
+
 # Defaults (change inside Admin Panel anytime)
 DEFAULT_SETTINGS = {
     "currency": "NGN",
@@ -46,17 +89,694 @@ DEFAULT_SETTINGS = {
     "admin_id": ""                    # set after /claimadmin
 }
 
+# ========= PER-BOT STATE =========
+# All in-memory state (database handle, settings cache, metrics, caches, ...)
+# belongs to one bot. The module-level names DB, SETTINGS, METRICS, ... are
+# stand-ins that resolve to the bot whose update, job or task is running, so
+# one process can host several bots while the code below reads as if there
+# were one. The running bot is a context variable (see HOSTED BOTS): tasks
+# inherit it and Database.run carries it into executor threads.
+class _PerBot:
+    __slots__ = ("_attr",)
+
+    def __init__(self, attr: str):
+        object.__setattr__(self, "_attr", attr)
+
+    def _get(self):
+        return getattr(_CURRENT.get(), self._attr)
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+    def __contains__(self, item) -> bool:
+        return item in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self) -> int:
+        return len(self._get())
+
+    def __bool__(self) -> bool:
+        return bool(self._get())
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+
+    def __delitem__(self, key):
+        del self._get()[key]
+
+# ========= METRICS =========
+# In-process counters and latency histograms for handlers, SQL statements and
+# outbound Bot API calls. Served in Prometheus text format on a local port and
+# summarised by the admin /stats command. Recording is a perf_counter() pair,
+# a dict lookup and a bucket increment, so leaving it on costs next to nothing.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bucket bound containing the q-quantile (inf if above the last bucket)."""
+        want = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= want:
+                return bound
+        return float("inf")
+
+class Metrics:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}    # (name, labels) -> int
+        self._lock = threading.Lock()  # DB metrics are recorded from executor threads
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.observe(seconds)
+
+    def inc(self, name: str, labels: tuple, n: int = 1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe_sql(self, query: str, seconds: float):
+        self.observe("bot_db_query_seconds", (("sql", _sql_label(query)),), seconds)
+
+    def counter_total(self, name: str) -> int:
+        with self._lock:
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def series(self, name: str) -> list:
+        """[(labels dict, Histogram)] for one histogram name."""
+        with self._lock:
+            return [(dict(labels), h) for (n, labels), h in self.histograms.items() if n == name]
+
+@lru_cache(maxsize=1024)
+def _sql_label(query: str) -> str:
+    return " ".join(query.split())
+
+def _fmt_labels(labels) -> str:
+    if not labels:
+        return ""
+    inner = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + inner + "}"
+
+def render_metrics(sources: list) -> str:
+    """Prometheus text for [(extra labels, Metrics)], one entry per hosted bot."""
+    out, histograms, counters = [], [], []
+    for extra, m in sources:
+        with m._lock:
+            histograms += [((name, extra + labels), h) for (name, labels), h in m.histograms.items()]
+            counters += [((name, extra + labels), v) for (name, labels), v in m.counters.items()]
+        out.append(f"bot_uptime_seconds{_fmt_labels(extra)} {time.time() - m.started:.0f}")
+    histograms.sort(key=lambda kv: kv[0])
+    counters.sort(key=lambda kv: kv[0])
+    last = None
+    for (name, labels), h in histograms:
+        if name != last:
+            out.append(f"# TYPE {name} histogram")
+            last = name
+        cum = 0
+        for bound, n in zip(LATENCY_BUCKETS, h.counts):
+            cum += n
+            out.append(f"{name}_bucket{_fmt_labels(labels + (('le', bound),))} {cum}")
+        out.append(f"{name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {h.count}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {h.total:.6f}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {h.count}")
+    for (name, labels), v in counters:
+        if name != last:
+            out.append(f"# TYPE {name} counter")
+            last = name
+        out.append(f"{name}{_fmt_labels(labels)} {v}")
+    return "\n".join(out) + "\n"
+
+METRICS = _PerBot("metrics")
+
+class MeteredRequest(BaseRequest):
+    """Wraps a BaseRequest to time every Bot API call and count errors/429s."""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE) -> Tuple[int, bytes]:
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        t0 = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+        except Exception:
+            METRICS.inc("bot_api_errors_total", labels + (("code", "network"),))
+            raise
+        finally:
+            METRICS.observe("bot_api_seconds", labels, time.perf_counter() - t0)
+        if code == 429:
+            METRICS.inc("bot_api_retry_after_total", labels)
+        if code >= 300:
+            METRICS.inc("bot_api_errors_total", labels + (("code", str(code)),))
+        return code, payload
+
+def _handler_route(name: str, update: Update, context) -> str:
+    if update.callback_query and update.callback_query.data:
+        # keep label cardinality bounded: "admin:bc_cancel:17" -> "admin:bc_cancel"
+        return ":".join(update.callback_query.data.split(":", 2)[:2])
+    if name == "on_text":
+        awaitable = context.user_data.get("await") if context.user_data is not None else None
+        return awaitable[0] if awaitable else "idle"
+    return ""
+
+def timed(callback: Callable) -> Callable:
+    name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update: Update, context):
+        if not METRICS.enabled:
+            return await callback(update, context)
+        labels = (("handler", name), ("route", _handler_route(name, update, context)))
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            METRICS.observe("bot_handler_seconds", labels, time.perf_counter() - t0)
+    return wrapper
+
+async def _metrics_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        body = render_metrics([(b.labels, b.metrics) for b in _HOSTED]).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+_METRICS_SERVER: Optional[asyncio.AbstractServer] = None
+
+async def start_metrics_server():
+    global _METRICS_SERVER
+    if METRICS.enabled and METRICS_PORT and _METRICS_SERVER is None:
+        _METRICS_SERVER = await asyncio.start_server(_metrics_client, METRICS_HOST, METRICS_PORT)
+
+async def stop_metrics_server():
+    global _METRICS_SERVER
+    if _METRICS_SERVER is not None:
+        _METRICS_SERVER.close()
+        await _METRICS_SERVER.wait_closed()
+        _METRICS_SERVER = None
+
+# ========= OUTBOUND SCHEDULER =========
+# Every Bot API call goes through this rate limiter (PTB's BaseRateLimiter
+# hook). Calls wait for a per-chat token (message-type methods only) and
+# then for a global token that goes to the most urgent waiter first: callback
+# answers, then interactive replies, then bulk traffic (broadcasts, reminders,
+# digests pass rate_limit_args=PRIO_BULK). RetryAfter pauses the global gate
+# and the call is retried. An editMessageText still waiting when a newer edit
+# of the same message arrives is dropped and resolves with the newer result.
+OUT_RATE = 30.0              # calls/second across all chats
+OUT_CHAT_RATE = 1.0          # messages/second per private chat
+OUT_CHAT_BURST = 3.0
+OUT_GROUP_RATE = 20 / 60.0   # messages/second per group chat
+OUT_MAX_RETRIES = 3
+OUT_TRACKED_CHATS = 100_000
+
+PRIO_ANSWER, PRIO_INTERACTIVE, PRIO_BULK = 0, 1, 2
+_PRIO_NAMES = ("answer", "interactive", "bulk")
+
+# lookups that don't count against the message limits
+_OUT_UNLIMITED = frozenset({"getMe", "getChatMember", "getChat", "getFile", "getWebhookInfo",
+                            "setWebhook", "deleteWebhook", "close", "logOut"})
+_OUT_CHAT_LIMITED = ("send", "edit", "copy", "forward")
+
+def take_token(b: list, rate: float, burst: float, now: float) -> float:
+    """One token-bucket step on b = [tokens, stamp, ...]: refill, then take a
+    token and return 0, or return seconds until one is free. Every limiter in
+    this file (outbound gates, per-chat limits, the flood gate) is built on it."""
+    b[0] = min(burst, b[0] + (now - b[1]) * rate)
+    b[1] = now
+    if b[0] >= 1:
+        b[0] -= 1
+        return 0.0
+    return (1 - b[0]) / rate
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._bucket = [self.capacity, time.monotonic()]
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (used on 429 RetryAfter)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _take(self) -> float:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        return take_token(self._bucket, self.rate, self.capacity, now)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                wait = self._take()
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+class PriorityGate(TokenBucket):
+    """Token bucket that hands tokens to the lowest-priority-number waiter first."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        super().__init__(rate, capacity)
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = 0
+        self._pump_task: Optional[asyncio.Task] = None
+
+    async def acquire(self, priority: int):
+        if not self._waiters and not self._take():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self):
+        while self._waiters:
+            if self._waiters[0][2].done():  # skip waiters that were cancelled
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+class _PendingEdit:
+    __slots__ = ("newer", "done")
+
+    def __init__(self):
+        self.newer: Optional["_PendingEdit"] = None
+        self.done = asyncio.get_running_loop().create_future()
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, group_rate: float,
+                 shared: Optional[PriorityGate] = None):
+        self.gate = PriorityGate(rate)
+        self.shared = shared  # process-wide budget when several bots share one process
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._chats = OrderedDict()  # chat id -> [tokens, stamp]
+        self._edits = {}             # (chat id, message id) -> _PendingEdit not yet sent
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_wait(self, chat_id) -> float:
+        """Take a token for `chat_id` and return 0, or return seconds until one is free."""
+        rate = self.chat_rate if not str(chat_id).startswith("-") else self.group_rate
+        now = time.monotonic()
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = self._chats[chat_id] = [self.chat_burst, now]
+            if len(self._chats) > OUT_TRACKED_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return take_token(b, rate, self.chat_burst, now)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in _OUT_UNLIMITED:
+            return await callback(*args, **kwargs)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            priority = PRIO_ANSWER if endpoint == "answerCallbackQuery" else PRIO_INTERACTIVE
+        chat_id = data.get("chat_id") if endpoint.startswith(_OUT_CHAT_LIMITED) else None
+        edit = key = None
+        if endpoint == "editMessageText" and chat_id is not None and data.get("message_id"):
+            key = (chat_id, data["message_id"])
+            edit = _PendingEdit()
+            prev = self._edits.get(key)
+            if prev is not None:
+                prev.newer = edit
+            self._edits[key] = edit
+        try:
+            result = await self._send(callback, args, kwargs, priority, chat_id, edit, key)
+        except asyncio.CancelledError:
+            if edit is not None:
+                edit.done.cancel()
+            raise
+        except Exception as e:
+            if edit is not None and not edit.done.done():
+                edit.done.set_exception(e)
+                edit.done.exception()  # only read by a coalesced older edit, if any
+            raise
+        if edit is not None and not edit.done.done():
+            edit.done.set_result(result)
+        return result
+
+    async def _send(self, callback, args, kwargs, priority: int, chat_id, edit, key):
+        t0 = time.perf_counter()
+        for attempt in range(OUT_MAX_RETRIES + 1):
+            while True:
+                if chat_id is not None:
+                    while True:
+                        if edit is not None and edit.newer is not None:
+                            break
+                        wait = self._chat_wait(chat_id)
+                        if not wait:
+                            break
+                        await asyncio.sleep(wait)
+                if edit is None or edit.newer is None:
+                    break
+                newer = edit.newer
+                METRICS.inc("bot_api_coalesced_total", ())
+                try:
+                    return await asyncio.shield(newer.done)
+                except asyncio.CancelledError:
+                    if not newer.done.cancelled():
+                        raise  # this call was cancelled
+                # the newer call was cancelled before it was answered: take its place
+                edit.newer = newer.newer
+                if self._edits.get(key) is newer:
+                    self._edits[key] = edit
+            await self.gate.acquire(priority)
+            if self.shared is not None:
+                await self.shared.acquire(priority)
+            if edit is not None and self._edits.get(key) is edit:
+                del self._edits[key]  # in flight; later edits must go out after it
+            if attempt == 0:
+                METRICS.observe("bot_api_queue_seconds", (("priority", _PRIO_NAMES[priority]),),
+                                time.perf_counter() - t0)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == OUT_MAX_RETRIES:
+                    raise
+                self.gate.pause(float(e.retry_after))
+
 # ========= DATABASE =========
-def db_exec(query: str, params: tuple = ()):
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("PRAGMA journal_mode=WAL")
-        cur = conn.cursor()
-        cur.execute(query, params)
-        conn.commit()
-        return cur
+# One long-lived writer connection plus a small pool of read-only connections.
+# WAL lets readers run alongside the writer; every blocking call is pushed to a
+# dedicated thread pool so a slow fsync never stalls the event loop.
+DB_READERS = 4
+
+class Database:
+    def __init__(self, path: str, readers: int = DB_READERS, archive_path: Optional[str] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        self.path = path
+        self.readers = readers
+        self.archive_path = archive_path  # attached as schema "archive" on every connection
+        self._writer: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.Lock()
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._executor = executor
+        self._own_executor = executor is None  # a shared pool is shut down by its owner
+        # On a shared pool, jobs of this database that are waiting for a reader or
+        # the write lock would otherwise sit on threads the other bots need.
+        self._slots = asyncio.Semaphore(readers + 1) if executor is not None else None
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        # isolation_level=None -> autocommit; transactions are opened explicitly.
+        # cached_statements keeps prepared statements around for reuse.
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               cached_statements=256)
+        conn.execute("PRAGMA busy_timeout=5000")
+        if self.archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def open(self):
+        if self._writer is not None:
+            return
+        self._writer = self._connect()
+        # only takes effect on a new file; existing ones need one full VACUUM (/db vacuum)
+        self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        for _ in range(self.readers):
+            self._pool.put(self._connect(readonly=True))
+        if self._own_executor:
+            self._executor = ThreadPoolExecutor(max_workers=self.readers + 1, thread_name_prefix="db")
+
+    def set_trace_callback(self, fn: Optional[Callable[[str], None]]):
+        """Install `fn` as the statement trace callback on every connection."""
+        with self._write_lock:
+            self._writer.set_trace_callback(fn)
+        conns = [self._pool.get() for _ in range(self.readers)]
+        for conn in conns:
+            conn.set_trace_callback(fn)
+            self._pool.put(conn)
+
+    def close(self):
+        if self._own_executor and self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    # --- blocking API (startup code and executor threads) ---
+    def fetchone(self, query: str, params: tuple = ()):
+        conn = self._pool.get()
+        t0 = time.perf_counter()
+        try:
+            return conn.execute(query, params).fetchone()
+        finally:
+            self._pool.put(conn)
+            METRICS.observe_sql(query, time.perf_counter() - t0)
+
+    def fetchall(self, query: str, params: tuple = ()) -> list:
+        conn = self._pool.get()
+        t0 = time.perf_counter()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            self._pool.put(conn)
+            METRICS.observe_sql(query, time.perf_counter() - t0)
+
+    def execute(self, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._write_lock:
+            t0 = time.perf_counter()
+            try:
+                return self._writer.execute(query, params)
+            finally:
+                METRICS.observe_sql(query, time.perf_counter() - t0)
+
+    @contextmanager
+    def transaction(self):
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def run_in_transaction(self, fn: Callable, *args):
+        with self.transaction() as conn:
+            return fn(conn, *args)
+
+    def checkpoint(self, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+        """Run a WAL checkpoint; returns (busy, wal frames, frames checkpointed)."""
+        with self._write_lock:
+            return tuple(self._writer.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+    def vacuum(self):
+        """Full VACUUM (blocks writers while it runs); also applies auto_vacuum=INCREMENTAL."""
+        with self._write_lock:
+            self._writer.execute("VACUUM")
+
+    @contextmanager
+    def snapshot(self):
+        """Dedicated read-only connection holding one consistent snapshot, for long scans.
+
+        Kept out of the reader pool so a slow export can't starve handlers.
+        """
+        conn = self._connect(readonly=True)
+        try:
+            conn.execute("BEGIN")
+            yield conn
+        finally:
+            conn.close()
+
+    # --- async API (handlers) ---
+    async def run(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        # the copied context keeps the current bot (see PER-BOT STATE) in the worker thread
+        if self._slots is None:
+            return await loop.run_in_executor(self._executor, contextvars.copy_context().run, fn, *args)
+        await self._slots.acquire()
+        try:
+            job = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # released when the job ends, not when the caller stops waiting for it
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._slots.release))
+        return await asyncio.wrap_future(job)
+
+DB = _PerBot("db")
+
+async def db_fetchone(query: str, params: tuple = ()):
+    return await DB.run(DB.fetchone, query, params)
+
+async def db_fetchall(query: str, params: tuple = ()) -> list:
+    return await DB.run(DB.fetchall, query, params)
+
+async def db_exec(query: str, params: tuple = ()) -> sqlite3.Cursor:
+    return await DB.run(DB.execute, query, params)
+
+class GroupCommitter:
+    """Batches concurrent write jobs into one transaction (one fsync) per flush.
+
+    Jobs are ``fn(conn, *args)`` callables. Whatever queues up while a batch is
+    committing goes into the next batch; each job runs in its own savepoint so
+    one failure doesn't roll back its neighbours.
+    """
+
+    def __init__(self, db: Database, max_batch: int = 512):
+        self.db = db
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.last_commit = 0.0  # monotonic time of the last flushed batch
+
+    async def submit(self, fn: Callable, *args):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, args, fut))
+        return await fut
+
+    async def _run(self):
+        stop = False
+        while not stop:
+            job = await self._queue.get()
+            if job is None:
+                return
+            batch = [job]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                job = self._queue.get_nowait()
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+            try:
+                results = await self.db.run(self._apply, batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            self.last_commit = time.monotonic()
+            for (_, _, fut), res in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+    def _apply(self, batch: list) -> list:
+        results = []
+        t_batch = time.perf_counter()
+        with self.db.transaction() as conn:
+            for fn, args, _ in batch:
+                conn.execute("SAVEPOINT job")
+                t0 = time.perf_counter()
+                try:
+                    results.append(fn(conn, *args))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append(e)
+                METRICS.observe_sql("txn:" + getattr(fn, "__qualname__", "job"), time.perf_counter() - t0)
+        METRICS.observe("bot_db_commit_seconds", (), time.perf_counter() - t_batch)
+        METRICS.inc("bot_db_commit_jobs_total", (), len(batch))
+        return results
+
+    async def close(self):
+        """Commit everything queued so far, then stop the flusher."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
 
-def init_db():
-    db_exec("""
+WRITER = _PerBot("writer")
+
+async def db_write(fn: Callable, *args):
+    return await WRITER.submit(fn, *args)
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> bool:
+    """Add the column if missing; returns True if it was added."""
+    cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+# ========= MIGRATIONS =========
+# Schema changes are numbered steps keyed on PRAGMA user_version. init_db runs
+# the missing steps in one transaction; when the file is already current it
+# only reads the version, the settings and the banned ids (both indexed), so a
+# cold start costs the same however big bot.db is. Append new steps; never
+# edit a released one.
+def _migration_1(conn: sqlite3.Connection):
+    """Baseline: everything bot.db could contain before versioning (idempotent)."""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users(
             id INTEGER PRIMARY KEY,
             balance REAL DEFAULT 0,
@@ -68,13 +788,13 @@ def init_db():
             ref_credit_given INTEGER DEFAULT 0
         )
     """)
-    db_exec("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS settings(
             key TEXT PRIMARY KEY,
             value TEXT
         )
     """)
-    db_exec("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS withdraw_requests(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -84,117 +804,451 @@ def init_db():
             created_at TEXT
         )
     """)
-    # load defaults
-    for k, v in DEFAULT_SETTINGS.items():
-        if get_setting(k) is None:
-            set_setting(k, v)
-
-def get_setting(key: str) -> Optional[str]:
-    cur = db_exec("SELECT value FROM settings WHERE key=?", (key,))
-    row = cur.fetchone()
-    return row[0] if row else None
-
-def set_setting(key: str, value: str):
-    db_exec("REPLACE INTO settings(key,value) VALUES(?,?)", (key, value))
-
-def add_user_if_not_exists(user_id: int, ref_by: Optional[int] = None):
-    cur = db_exec("SELECT id FROM users WHERE id=?", (user_id,))
-    if not cur.fetchone():
-        db_exec(
-            "INSERT INTO users(id, balance, is_banned, ref_by, created_at, last_bonus_at, passed_join_check, ref_credit_given) VALUES(?,?,?,?,?,?,?,?)",
-            (user_id, 0.0, 0, ref_by, datetime.utcnow().isoformat(), None, 0, 0)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ledger(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            delta REAL,
+            reason TEXT,
+            created_at TEXT
         )
+    """)
+    _ensure_column(conn, "withdraw_requests", "processed_at", "TEXT")
+    new_stats = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='referral_stats'").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_stats(
+            user_id INTEGER PRIMARY KEY,
+            referred INTEGER DEFAULT 0,
+            verified INTEGER DEFAULT 0,
+            earned REAL DEFAULT 0
+        )
+    """)
+    if new_stats:
+        _backfill_referral_stats(conn)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            status TEXT,
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            chat_id INTEGER,
+            message_id INTEGER,
+            created_at TEXT
+        )
+    """)
+    _ensure_column(conn, "users", "is_blocked", "INTEGER DEFAULT 0")
+    if _ensure_column(conn, "users", "last_bonus_ts", "INTEGER"):
+        conn.execute("UPDATE users SET last_bonus_ts = CAST(strftime('%s', last_bonus_at) AS INTEGER) "
+                     "WHERE last_bonus_at IS NOT NULL")
+    _ensure_column(conn, "users", "bonus_remind", "INTEGER DEFAULT 0")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state(
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at TEXT
+        )
+    """)
+    conn.executemany("INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)", list(DEFAULT_SETTINGS.items()))
+
+def _epoch(col: str) -> str:
+    return f"CAST(strftime('%s', {col}) AS INTEGER)"
+
+def _minor(col: str) -> str:
+    return f"CAST(ROUND(COALESCE({col}, 0) * {MINOR_UNITS}) AS INTEGER)"
+
+def _rebuild(conn: sqlite3.Connection, table: str, columns: str, select: str):
+    conn.execute(f"CREATE TABLE {table}_new({columns})")
+    conn.execute(f"INSERT INTO {table}_new SELECT {select} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def _migration_2(conn: sqlite3.Connection):
+    """Money as integer minor units, timestamps as unix seconds, plus handler indexes."""
+    _rebuild(conn, "users", """
+        id INTEGER PRIMARY KEY,
+        balance INTEGER NOT NULL DEFAULT 0,
+        is_banned INTEGER NOT NULL DEFAULT 0,
+        ref_by INTEGER,
+        created_at INTEGER,
+        last_bonus_ts INTEGER,
+        passed_join_check INTEGER NOT NULL DEFAULT 0,
+        ref_credit_given INTEGER NOT NULL DEFAULT 0,
+        is_blocked INTEGER NOT NULL DEFAULT 0,
+        bonus_remind INTEGER NOT NULL DEFAULT 0
+    """, f"""id, {_minor("balance")}, COALESCE(is_banned, 0), ref_by, {_epoch("created_at")}, last_bonus_ts,
+        COALESCE(passed_join_check, 0), COALESCE(ref_credit_given, 0), COALESCE(is_blocked, 0),
+        COALESCE(bonus_remind, 0)""")
+    _rebuild(conn, "withdraw_requests", """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        wallet TEXT,
+        status TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        processed_at INTEGER
+    """, f"""id, user_id, {_minor("amount")}, wallet, COALESCE(status, 'pending'),
+        COALESCE({_epoch("created_at")}, 0), {_epoch("processed_at")}""")
+    _rebuild(conn, "ledger", """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT,
+        created_at INTEGER
+    """, f"""id, user_id, {_minor("delta")}, reason, {_epoch("created_at")}""")
+    _rebuild(conn, "referral_stats", """
+        user_id INTEGER PRIMARY KEY,
+        referred INTEGER NOT NULL DEFAULT 0,
+        verified INTEGER NOT NULL DEFAULT 0,
+        earned INTEGER NOT NULL DEFAULT 0
+    """, f"""user_id, COALESCE(referred, 0), COALESCE(verified, 0), {_minor("earned")}""")
+    _rebuild(conn, "broadcasts", """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        status TEXT,
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        chat_id INTEGER,
+        message_id INTEGER,
+        created_at INTEGER
+    """, f"""id, text, status, last_user_id, sent, failed, blocked, chat_id, message_id, {_epoch("created_at")}""")
+    _rebuild(conn, "conversation_state", """
+        user_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        updated_at INTEGER
+    """, f"""user_id, state, {_epoch("updated_at")}""")
+    conn.execute("CREATE INDEX idx_users_ref_by ON users(ref_by)")
+    conn.execute("CREATE INDEX idx_users_bonus_due ON users(last_bonus_ts) WHERE bonus_remind=1")
+    conn.execute("CREATE INDEX idx_users_banned ON users(id) WHERE is_banned=1")
+    conn.execute("CREATE INDEX idx_wd_status_created ON withdraw_requests(status, created_at)")
+    conn.execute("CREATE INDEX idx_wd_user ON withdraw_requests(user_id, id)")
+    conn.execute("CREATE INDEX idx_ledger_user ON ledger(user_id, id)")
+    conn.execute("CREATE INDEX idx_refstats_verified ON referral_stats(verified)")
+
+def _migration_3(conn: sqlite3.Connection):
+    """Dashboard summary tables and the sign-up index their refresh reads."""
+    conn.execute("CREATE INDEX idx_users_created ON users(created_at)")
+    conn.execute("CREATE TABLE dashboard_totals(key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    conn.execute("""
+        CREATE TABLE dashboard_daily(
+            day INTEGER PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            bonus_claims INTEGER NOT NULL DEFAULT 0,
+            referrals INTEGER NOT NULL DEFAULT 0,
+            credited INTEGER NOT NULL DEFAULT 0,
+            withdrawn INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE TABLE dashboard_pending(band INTEGER PRIMARY KEY, requests INTEGER NOT NULL, "
+                 "amount INTEGER NOT NULL)")
+
+MIGRATIONS = (_migration_1, _migration_2, _migration_3)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations inside the caller's transaction; returns how many ran."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"{DB.path} has schema v{version}; this build only knows v{SCHEMA_VERSION}")
+    for step in MIGRATIONS[version:]:
+        step(conn)
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return SCHEMA_VERSION - version
 
-def get_balance(user_id: int) -> float:
-    cur = db_exec("SELECT balance FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    return float(row[0]) if row else 0.0
-
-def set_balance(user_id: int, amount: float):
-    db_exec("UPDATE users SET balance=? WHERE id=?", (amount, user_id))
-
-def change_balance(user_id: int, delta: float):
-    bal = get_balance(user_id)
-    set_balance(user_id, bal + delta)
-
-def set_ban(user_id: int, banned: bool):
-    db_exec("UPDATE users SET is_banned=? WHERE id=?", (1 if banned else 0, user_id))
-
-def is_banned(user_id: int) -> bool:
-    cur = db_exec("SELECT is_banned FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    return bool(row[0]) if row else False
-
-def all_user_ids() -> List[int]:
-    cur = db_exec("SELECT id FROM users")
-    return [r[0] for r in cur.fetchall()]
-
-def set_passed_join_check(user_id: int):
-    db_exec("UPDATE users SET passed_join_check=1 WHERE id=?", (user_id,))
-
-def has_passed_join_check(user_id: int) -> bool:
-    cur = db_exec("SELECT passed_join_check FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    return bool(row[0]) if row else False
-
-def get_ref_by(user_id: int) -> Optional[int]:
-    cur = db_exec("SELECT ref_by FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    return int(row[0]) if row and row[0] is not None else None
-
-def set_ref_by(user_id: int, ref_by: Optional[int]):
-    db_exec("UPDATE users SET ref_by=? WHERE id=?", (ref_by, user_id))
-
-def set_ref_credit_given(user_id: int):
-    db_exec("UPDATE users SET ref_credit_given=1 WHERE id=?", (user_id,))
+def init_db():
+    DB.open()
+    if DB.fetchone("PRAGMA user_version")[0] != SCHEMA_VERSION:
+        with DB.transaction() as conn:
+            ran = migrate(conn)
+        if ran:
+            print(f"Database migrated to schema v{SCHEMA_VERSION} ({ran} step(s)).")
+    with DB.transaction() as conn:
+        _ensure_withdraw_archive(conn)
+    SETTINGS.load(DB.fetchall("SELECT key, value FROM settings"))
+    BANNED.clear()
+    BANNED.update(r[0] for r in DB.fetchall("SELECT id FROM users WHERE is_banned=1"))
+
+# ========= LEDGER =========
+# Every balance change is an atomic `balance = balance + ?` plus a ledger row,
+# applied together through the group committer. Money is stored as integer
+# minor units (kobo, cents); functions taking a conn work in minor units, the
+# async API and everything shown to users in major units.
+MINOR_UNITS = 100
+
+MAX_MINOR = 2 ** 63 - 1  # SQLite INTEGER range
+
+def to_minor(amount: float) -> int:
+    return int(round(amount * MINOR_UNITS))
+
+def parse_amount(raw: str) -> float:
+    """float(raw), rejecting nan/inf and amounts whose minor units don't fit an SQLite INTEGER."""
+    amount = float(raw)
+    if not math.isfinite(amount) or abs(round(amount * MINOR_UNITS)) > MAX_MINOR:
+        raise ValueError(f"amount out of range: {raw!r}")
+    return amount
+
+def to_major(minor: Optional[int]) -> float:
+    return (minor or 0) / MINOR_UNITS
+
+REASON_DAILY_BONUS = "daily_bonus"
+REASON_REFERRAL = "referral"
+REASON_ADMIN_ADD = "admin_add"
+REASON_ADMIN_REMOVE = "admin_remove"
+REASON_WITHDRAW = "withdraw"
+
+def _apply_ledger(conn: sqlite3.Connection, user_id: int, delta: int, reason: str) -> Optional[int]:
+    cur = conn.execute("UPDATE users SET balance = balance + ? WHERE id=?", (delta, user_id))
+    if cur.rowcount == 0:
+        return None
+    conn.execute("INSERT INTO ledger(user_id, delta, reason, created_at) VALUES(?,?,?,?)",
+                 (user_id, delta, reason, int(time.time())))
+    return conn.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()[0]
+
+async def change_balance(user_id: int, delta: float, reason: str) -> Optional[float]:
+    """Apply a credit/debit and return the new balance (None if no such user)."""
+    bal = await db_write(_apply_ledger, user_id, to_minor(delta), reason)
+    return None if bal is None else to_major(bal)
+
+async def set_ban(user_id: int, banned: bool):
+    await db_exec("UPDATE users SET is_banned=? WHERE id=?", (1 if banned else 0, user_id))
+    if banned:
+        BANNED.add(user_id)
+    else:
+        BANNED.discard(user_id)
+
+# ========= REFERRALS =========
+# Per-referrer counters are kept up to date in the same transaction as the
+# event that changes them (new referred user, referral credit), so the
+# "My referrals" screen and the leaderboard never aggregate over users.
+LEADERBOARD_SIZE = 10
+LEADERBOARD_REFRESH = 300.0  # seconds
+
+_REF_REFERRED = ("INSERT INTO referral_stats(user_id, referred) VALUES(?, 1) "
+                 "ON CONFLICT(user_id) DO UPDATE SET referred = referred + 1")
+_REF_VERIFIED = ("INSERT INTO referral_stats(user_id, verified, earned) VALUES(?, 1, ?) "
+                 "ON CONFLICT(user_id) DO UPDATE SET verified = verified + 1, earned = earned + excluded.earned")
+
+def _insert_user(conn: sqlite3.Connection, user_id: int, ref_by: Optional[int]) -> bool:
+    cur = conn.execute("INSERT OR IGNORE INTO users(id, ref_by, created_at) VALUES(?,?,?)",
+                       (user_id, ref_by, int(time.time())))
+    created = cur.rowcount > 0
+    if created and ref_by:
+        conn.execute(_REF_REFERRED, (ref_by,))
+    return created
+
+async def add_user_if_not_exists(user_id: int, ref_by: Optional[int] = None) -> bool:
+    """Create the user row if missing; returns True if it was created."""
+    return await db_write(_insert_user, user_id, ref_by)
+
+def _backfill_referral_stats(conn: sqlite3.Connection):
+    """One-off fill for databases that predate referral_stats."""
+    conn.execute("""
+        INSERT INTO referral_stats(user_id, referred, verified, earned)
+        SELECT ref_by, COUNT(*), SUM(ref_credit_given), 0 FROM users
+        WHERE ref_by IS NOT NULL GROUP BY ref_by
+    """)
+    conn.execute("""
+        UPDATE referral_stats SET earned = COALESCE(
+            (SELECT SUM(delta) FROM ledger WHERE ledger.user_id = referral_stats.user_id AND reason = ?), 0)
+    """, (REASON_REFERRAL,))
+
+async def referral_stats(user_id: int) -> Tuple[int, int, float]:
+    row = await db_fetchone("SELECT referred, verified, earned FROM referral_stats WHERE user_id=?", (user_id,))
+    return (int(row[0]), int(row[1]), to_major(row[2])) if row else (0, 0, 0.0)
+
+async def recent_referrals(user_id: int, limit: int = 10) -> list:
+    return await db_fetchall(
+        "SELECT id, passed_join_check FROM users WHERE ref_by=? ORDER BY id DESC LIMIT ?", (user_id, limit))
+
+_LEADERBOARD = _PerBot("leaderboard")  # {"at": monotonic time, "rows": [...]}
+
+async def leaderboard() -> list:
+    """Top referrers by verified referrals; refreshed at most every LEADERBOARD_REFRESH seconds."""
+    now = time.monotonic()
+    if not _LEADERBOARD["at"] or now - _LEADERBOARD["at"] >= LEADERBOARD_REFRESH:
+        rows = await db_fetchall(
+            "SELECT user_id, verified, referred, earned FROM referral_stats "
+            "ORDER BY verified DESC LIMIT ?", (LEADERBOARD_SIZE,))
+        _LEADERBOARD["rows"] = [(uid, v, r, to_major(e)) for uid, v, r, e in rows]
+        _LEADERBOARD["at"] = now
+    return _LEADERBOARD["rows"]
+
+# ========= USER RECORD =========
+# Handlers load the caller's row once per update (one SELECT), read and mutate
+# it in memory and write all changed columns back with a single UPDATE.
+class UserRecord:
+    __slots__ = ("id", "balance", "is_banned", "ref_by", "created_at", "last_bonus_ts",
+                 "passed_join_check", "ref_credit_given", "is_blocked", "bonus_remind", "_dirty", "_entries")
+
+    COLUMNS = ("id", "balance", "is_banned", "ref_by", "created_at", "last_bonus_ts",
+               "passed_join_check", "ref_credit_given", "is_blocked", "bonus_remind")
+
+    def __init__(self, row: tuple):
+        (self.id, balance, is_banned, self.ref_by, self.created_at, self.last_bonus_ts,
+         passed_join_check, ref_credit_given, is_blocked, bonus_remind) = row
+        self.balance = to_major(balance)
+        self.is_banned = bool(is_banned)
+        self.passed_join_check = bool(passed_join_check)
+        self.ref_credit_given = bool(ref_credit_given)
+        self.is_blocked = bool(is_blocked)
+        self.bonus_remind = bool(bonus_remind)
+        self._dirty = set()
+        self._entries = []
+
+    @classmethod
+    def blank(cls, user_id: int) -> "UserRecord":
+        return cls((user_id, 0.0, 0, None, None, None, 0, 0, 0, 0))
+
+    def set(self, field: str, value):
+        setattr(self, field, value)
+        self._dirty.add(field)
+
+    def credit(self, delta: float, reason: str, user_id: Optional[int] = None):
+        """Queue a ledger entry (for this user by default) to go out with save_user."""
+        self._entries.append((user_id or self.id, delta, reason))
+
+    def _column_value(self, field: str):
+        v = getattr(self, field)
+        if isinstance(v, bool):
+            return int(v)
+        return v
+
+    def pending_update(self) -> Optional[Tuple[str, tuple]]:
+        if not self._dirty:
+            return None
+        fields = sorted(self._dirty)
+        sql = "UPDATE users SET " + ", ".join(f"{f}=?" for f in fields) + " WHERE id=?"
+        return sql, tuple(self._column_value(f) for f in fields) + (self.id,)
+
+    def _flush(self, conn: sqlite3.Connection, update: Optional[Tuple[str, tuple]], entries: list):
+        if update:
+            conn.execute(*update)
+        for user_id, delta, reason in entries:
+            delta = to_minor(delta)
+            bal = _apply_ledger(conn, user_id, delta, reason)
+            if reason == REASON_REFERRAL:
+                conn.execute(_REF_VERIFIED, (user_id, delta if bal is not None else 0))
+            if user_id == self.id and bal is not None:
+                self.balance = to_major(bal)
+
+_SELECT_USER = "SELECT " + ", ".join(UserRecord.COLUMNS) + " FROM users WHERE id=?"
+
+class BotContext(CallbackContext):
+    """CallbackContext carrying the caller's UserRecord for the current update."""
+    __slots__ = ("user_record",)
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.user_record: Optional[UserRecord] = None
+
+async def load_user(context: "BotContext", user_id: int) -> UserRecord:
+    rec = context.user_record
+    if rec is None or rec.id != user_id:
+        row = await db_fetchone(_SELECT_USER, (user_id,))
+        rec = UserRecord(row) if row else UserRecord.blank(user_id)
+        context.user_record = rec
+    return rec
+
+async def save_user(rec: UserRecord):
+    """Write dirty columns and queued ledger entries in one transaction."""
+    pending = rec.pending_update()
+    entries = rec._entries
+    if pending or entries:
+        rec._dirty = set()
+        rec._entries = []
+        await db_write(rec._flush, pending, entries)
+
+# ========= SETTINGS CACHE =========
+# Settings are read on nearly every update, so they live in memory. The table
+# is loaded once in init_db and set_setting writes through to both.
+def _to_float(raw: Optional[str], default: float) -> float:
+    try:
+        return parse_amount(raw)
+    except (TypeError, ValueError):
+        return default
 
-def ref_credit_given(user_id: int) -> bool:
-    cur = db_exec("SELECT ref_credit_given FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    return bool(row[0]) if row else False
+def _to_channels(raw: Optional[str]) -> Tuple[str, ...]:
+    try:
+        lst = json.loads(raw or "[]")
+        return tuple(c.strip() for c in lst if c.strip())
+    except Exception:
+        return ()
+
+class Settings:
+    def __init__(self):
+        self.raw = dict(DEFAULT_SETTINGS)
+        self._parse()
+
+    def _parse(self):
+        r = self.raw
+        self.currency = r.get("currency") or "NGN"
+        self.min_withdraw = _to_float(r.get("min_withdraw"), 1000.0)
+        self.max_withdraw = _to_float(r.get("max_withdraw"), 500000.0)
+        self.withdraw_open = r.get("withdraw_open") == "1"
+        self.daily_bonus_amount = _to_float(r.get("daily_bonus_amount"), 50.0)
+        self.referral_bonus_amount = _to_float(r.get("referral_bonus_amount"), 100.0)
+        self.channels = _to_channels(r.get("channels"))
+        a = r.get("admin_id")
+        self.admin_id = int(a) if a else None
+
+    def load(self, rows):
+        self.raw.update(rows)
+        self._parse()
+
+    def update(self, key: str, value: str):
+        self.raw[key] = value
+        self._parse()
+
+SETTINGS = _PerBot("settings")
 
-def set_last_bonus(user_id: int, dt: datetime):
-    db_exec("UPDATE users SET last_bonus_at=? WHERE id=?", (dt.isoformat(), user_id))
+def get_setting(key: str) -> Optional[str]:
+    return SETTINGS.raw.get(key)
 
-def get_last_bonus(user_id: int) -> Optional[datetime]:
-    cur = db_exec("SELECT last_bonus_at FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    if row and row[0]:
-        return datetime.fromisoformat(row[0])
-    return None
+async def set_setting(key: str, value: str):
+    await db_exec("REPLACE INTO settings(key,value) VALUES(?,?)", (key, value))
+    SETTINGS.update(key, value)
+    if key == "channels":
+        JOIN_CACHE.clear()
 
 # ========= UTILS =========
 def admin_id() -> Optional[int]:
-    a = get_setting("admin_id")
-    return int(a) if a else None
+    return SETTINGS.admin_id
 
 def is_admin(uid: int) -> bool:
-    a = admin_id()
+    a = SETTINGS.admin_id
     return a == uid if a else False
 
-def parse_channels() -> List[str]:
-    raw = get_setting("channels") or "[]"
-    try:
-        lst = json.loads(raw)
-        return [c.strip() for c in lst if c.strip()]
-    except Exception:
-        return []
+def parse_channels() -> Tuple[str, ...]:
+    return SETTINGS.channels
 
 def fmt_amount(x: float) -> str:
-    curr = get_setting("currency") or "NGN"
-    return f"{curr} {x:,.2f}"
+    return f"{SETTINGS.currency} {x:,.2f}"
+
+def fmt_ts(ts: Optional[int]) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(ts)) if ts else ""
+
+# Keyboards are immutable, so each distinct one is built once and reused.
+MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎁 Daily Bonus", callback_data="user:bonus"),
+     InlineKeyboardButton("👥 Referral Link", callback_data="user:reflink")],
+    [InlineKeyboardButton("📢 Join Channels", callback_data="user:channels"),
+     InlineKeyboardButton("💸 Withdraw", callback_data="user:withdraw")],
+    [InlineKeyboardButton("📊 My Referrals", callback_data="user:myrefs"),
+     InlineKeyboardButton("ℹ️ Help", callback_data="user:help")],
+    [InlineKeyboardButton("🔔 Bonus Reminders", callback_data="user:remind")]
+])
 
 def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎁 Daily Bonus", callback_data="user:bonus"),
-         InlineKeyboardButton("👥 Referral Link", callback_data="user:reflink")],
-        [InlineKeyboardButton("📢 Join Channels", callback_data="user:channels"),
-         InlineKeyboardButton("💸 Withdraw", callback_data="user:withdraw")],
-        [InlineKeyboardButton("ℹ️ Help", callback_data="user:help")]
-    ])
+    return MAIN_MENU_KB
 
-def admin_panel_kb() -> InlineKeyboardMarkup:
-    wd = "ON" if (get_setting("withdraw_open") == "1") else "OFF"
+@lru_cache(maxsize=2)
+def _admin_panel_kb(withdraw_open: bool) -> InlineKeyboardMarkup:
+    wd = "ON" if withdraw_open else "OFF"
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("➕ Add Balance", callback_data="admin:add_balance"),
          InlineKeyboardButton("➖ Remove Balance", callback_data="admin:remove_balance")],
@@ -206,50 +1260,1011 @@ def admin_panel_kb() -> InlineKeyboardMarkup:
          InlineKeyboardButton("👁 View Channels", callback_data="admin:view_channels")],
         [InlineKeyboardButton("🚫 Ban User", callback_data="admin:ban"),
          InlineKeyboardButton("✅ Unban User", callback_data="admin:unban")],
+        [InlineKeyboardButton("📥 Bulk Import (CSV)", callback_data="admin:bulk_import")],
+        [InlineKeyboardButton("🧾 Withdrawals", callback_data="admin:wdq:0"),
+         InlineKeyboardButton("🔎 User Withdrawals", callback_data="admin:wd_history")],
+        [InlineKeyboardButton("🏆 Referral Top", callback_data="admin:ref_top")],
         [InlineKeyboardButton(f"💸 Withdraw: {wd} (toggle)", callback_data="admin:toggle_wd")],
         [InlineKeyboardButton("⬅️ Close", callback_data="admin:close")]
     ])
 
-async def send_user_home(update: Update, context: ContextTypes.DEFAULT_TYPE, text: Optional[str] = None):
+def admin_panel_kb() -> InlineKeyboardMarkup:
+    return _admin_panel_kb(SETTINGS.withdraw_open)
+
+async def send_user_home(update: Update, context: BotContext, text: Optional[str] = None):
     user = update.effective_user
-    bal = get_balance(user.id)
-    msg = text or f"Welcome, *{user.first_name}*!\nYour balance: *{fmt_amount(bal)}*"
+    rec = await load_user(context, user.id)
+    msg = text or f"Welcome, *{user.first_name}*!\nYour balance: *{fmt_amount(rec.balance)}*"
     if update.message:
         await update.message.reply_text(msg, reply_markup=main_menu_kb(), parse_mode=ParseMode.MARKDOWN)
     else:
         await update.callback_query.edit_message_text(msg, reply_markup=main_menu_kb(), parse_mode=ParseMode.MARKDOWN)
 
 # ========= JOIN CHECK =========
-async def check_user_joined_all(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+# Membership lookups run concurrently and stop at the first channel the user
+# hasn't joined. Results are kept in a small LRU: positives for a minute,
+# negatives only briefly so a user who just joined isn't turned away.
+JOIN_CACHE_SIZE = 50_000
+JOIN_CACHE_TTL = 60.0
+JOIN_CACHE_NEGATIVE_TTL = 5.0
+
+class TTLCache:
+    """Bounded LRU mapping with a per-entry expiry."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+JOIN_CACHE = _PerBot("join_cache")
+
+async def _is_member(bot, channel: str, user_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+    except Exception:
+        # Bot not admin or channel invalid; treat as not joined (and don't cache)
+        return False
+    joined = member.status not in ("left", "kicked")
+    JOIN_CACHE.set((channel, user_id), joined, JOIN_CACHE_TTL if joined else JOIN_CACHE_NEGATIVE_TTL)
+    return joined
+
+async def check_user_joined_all(context: BotContext, user_id: int) -> bool:
     channels = parse_channels()
     if not channels:
         return True
+    pending = []
     for ch in channels:
-        try:
-            member = await context.bot.get_chat_member(chat_id=ch, user_id=user_id)
-            status = member.status  # 'creator','administrator','member','restricted','left','kicked'
-            if status in ("left", "kicked"):
-                return False
-        except Exception:
-            # Bot not admin or channel invalid; treat as not joined
+        cached = JOIN_CACHE.get((ch, user_id))
+        if cached is False:
             return False
-    return True
+        if cached is None:
+            pending.append(ch)
+    if not pending:
+        return True
+    tasks = [asyncio.create_task(_is_member(context.bot, ch, user_id)) for ch in pending]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            if not await fut:
+                return False
+        return True
+    finally:
+        for t in tasks:
+            t.cancel()
 
-def channels_text() -> str:
-    channels = parse_channels()
+@lru_cache(maxsize=1)
+def _channels_text(channels: Tuple[str, ...]) -> str:
     if not channels:
         return "No channels set yet."
     lines = [f"• {c}" for c in channels]
     return "Please join all required channels, then press *I've joined*.\n\n" + "\n".join(lines)
 
-def channels_kb() -> InlineKeyboardMarkup:
-    channels = parse_channels()
+@lru_cache(maxsize=1)
+def _channels_kb(channels: Tuple[str, ...]) -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton(c, url=f"https://t.me/{c.lstrip('@')}")] for c in channels]
     rows.append([InlineKeyboardButton("✅ I've joined", callback_data="user:joinedcheck")])
     return InlineKeyboardMarkup(rows)
 
+def channels_text() -> str:
+    return _channels_text(parse_channels())
+
+def channels_kb() -> InlineKeyboardMarkup:
+    return _channels_kb(parse_channels())
+
+# ========= BROADCAST =========
+# Broadcasts run as background tasks: recipients are paged by primary key,
+# sent with bounded concurrency under a global token bucket, and progress is
+# saved after every page so a restart resumes where it stopped.
+BROADCAST_PAGE = 500
+BROADCAST_CONCURRENCY = 20
+BROADCAST_RATE = 25.0          # messages/second; Telegram allows ~30/s per bot
+BROADCAST_PROGRESS_EVERY = 5.0  # seconds between progress edits
+
+BULK_BUCKET = _PerBot("bulk_bucket")
+_BROADCASTS = _PerBot("broadcasts")  # broadcast id -> (task, cancel event)
+
+def broadcast_kb(bc_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🛑 Cancel broadcast", callback_data=f"admin:bc_cancel:{bc_id}")]])
+
+def broadcast_text(bc_id: int, status: str, sent: int, failed: int, blocked: int) -> str:
+    return (f"📢 Broadcast #{bc_id}: {status}\n"
+            f"Sent: {sent} | Failed: {failed} | Blocked: {blocked}")
+
+async def _broadcast_send(bot, uid: int, text: str, cancel: asyncio.Event, reply_markup=None) -> str:
+    # 429s are retried by the OutboundScheduler; one that still fails counts as failed
+    if cancel.is_set():
+        return "skipped"
+    await BULK_BUCKET.acquire()
+    try:
+        await bot.send_message(chat_id=uid, text=text, parse_mode=ParseMode.MARKDOWN,
+                               reply_markup=reply_markup, rate_limit_args=PRIO_BULK)
+        return "sent"
+    except Forbidden:
+        return "blocked"
+    except TelegramError:
+        return "failed"
+
+def _save_broadcast_page(conn: sqlite3.Connection, bc_id: int, last_id: int, sent: int, failed: int,
+                         blocked: int, blocked_ids: list):
+    if blocked_ids:
+        conn.executemany("UPDATE users SET is_blocked=1 WHERE id=?", [(u,) for u in blocked_ids])
+    conn.execute("UPDATE broadcasts SET last_user_id=?, sent=?, failed=?, blocked=? WHERE id=?",
+                 (last_id, sent, failed, blocked, bc_id))
+
+async def run_broadcast(app, bc_id: int, cancel: asyncio.Event):
+    row = await db_fetchone(
+        "SELECT text, last_user_id, sent, failed, blocked, chat_id, message_id FROM broadcasts WHERE id=?",
+        (bc_id,))
+    if not row:
+        return
+    text, last_id, sent, failed, blocked, chat_id, message_id = row
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send(uid: int) -> str:
+        async with sem:
+            return await _broadcast_send(app.bot, uid, text, cancel)
+
+    async def show(status: str, final: bool = False):
+        try:
+            await app.bot.edit_message_text(
+                broadcast_text(bc_id, status, sent, failed, blocked), chat_id=chat_id, message_id=message_id,
+                reply_markup=None if final else broadcast_kb(bc_id))
+        except TelegramError:
+            pass
+
+    last_shown = time.monotonic()
+    try:
+        while not cancel.is_set():
+            rows = await db_fetchall(
+                "SELECT id FROM users WHERE id > ? AND is_blocked=0 ORDER BY id LIMIT ?",
+                (last_id, BROADCAST_PAGE))
+            if not rows:
+                break
+            ids = [r[0] for r in rows]
+            results = await asyncio.gather(*(send(uid) for uid in ids))
+            blocked_ids = [uid for uid, res in zip(ids, results) if res == "blocked"]
+            sent += results.count("sent")
+            failed += results.count("failed")
+            blocked += len(blocked_ids)
+            last_id = ids[-1]
+            await db_write(_save_broadcast_page, bc_id, last_id, sent, failed, blocked, blocked_ids)
+            if time.monotonic() - last_shown >= BROADCAST_PROGRESS_EVERY:
+                last_shown = time.monotonic()
+                await show("running…")
+        status = "cancelled" if cancel.is_set() else "done"
+        await db_exec("UPDATE broadcasts SET status=? WHERE id=?", (status, bc_id))
+        await show(status, final=True)
+    finally:
+        _BROADCASTS.pop(bc_id, None)
+
+def start_broadcast(app, bc_id: int):
+    cancel = asyncio.Event()
+    _BROADCASTS[bc_id] = (asyncio.create_task(run_broadcast(app, bc_id, cancel)), cancel)
+
+async def cancel_broadcast(bc_id: int) -> bool:
+    entry = _BROADCASTS.get(bc_id)
+    if entry:
+        entry[1].set()
+        return True
+    cur = await db_exec("UPDATE broadcasts SET status='cancelled' WHERE id=? AND status='running'", (bc_id,))
+    return cur.rowcount > 0
+
+async def resume_broadcasts(app):
+    for (bc_id,) in await db_fetchall("SELECT id FROM broadcasts WHERE status='running'"):
+        start_broadcast(app, bc_id)
+
+async def stop_broadcasts():
+    # Leave status='running' so the next start picks them up again.
+    tasks = [t for t, _ in _BROADCASTS.values()]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ========= BONUS REMINDERS =========
+# Users who opt in get one reminder when their daily bonus becomes claimable
+# again. A job runs every REMIND_INTERVAL seconds and takes the next window of
+# due times (last_bonus_ts + BONUS_PERIOD) from the partial index on
+# last_bonus_ts, a page at a time. Each reminder goes out at its own due time
+# through the shared bulk token bucket, so the load follows the claim pattern
+# instead of spiking and interactive replies keep their share of the limit.
+# The window cursor is kept in the settings table so a restart picks up the
+# reminders that came due while the bot was down (up to REMIND_LOOKBACK back).
+BONUS_PERIOD = 86400
+REMIND_INTERVAL = 600
+REMIND_LOOKBACK = 86400
+REMIND_PAGE = 1000
+REMIND_CONCURRENCY = 10
+
+REMIND_TEXT = "🎁 Your daily bonus is ready to claim!"
+REMIND_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🎁 Claim Daily Bonus", callback_data="user:bonus")]])
+
+_REMIND_DUE = ("SELECT id, last_bonus_ts FROM users "
+               "WHERE bonus_remind=1 AND (last_bonus_ts, id) > (?, ?) AND last_bonus_ts < ? "
+               "AND is_banned=0 AND is_blocked=0 "
+               "ORDER BY last_bonus_ts, id LIMIT ?")
+
+_REMINDERS = _PerBot("reminders")          # running window tasks
+_REMIND_CURSOR = _PerBot("remind_cursor")  # [start of the next window (unix seconds)]
+
+def _mark_blocked(conn: sqlite3.Connection, user_ids: list):
+    conn.executemany("UPDATE users SET is_blocked=1 WHERE id=?", [(u,) for u in user_ids])
+
+async def send_reminders(app, start: float, end: float):
+    """Remind everyone whose bonus comes due in [start, end)."""
+    sem = asyncio.Semaphore(REMIND_CONCURRENCY)
+    cancel = asyncio.Event()
+
+    async def send(uid: int) -> str:
+        try:
+            return await _broadcast_send(app.bot, uid, REMIND_TEXT, cancel, reply_markup=REMIND_KB)
+        finally:
+            sem.release()
+
+    last_ts, last_id = int(start) - BONUS_PERIOD, 0
+    while True:
+        rows = await db_fetchall(_REMIND_DUE, (last_ts, last_id, int(end) - BONUS_PERIOD, REMIND_PAGE))
+        if not rows:
+            return
+        tasks = []
+        for uid, ts in rows:
+            delay = ts + BONUS_PERIOD - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await sem.acquire()
+            tasks.append((uid, asyncio.create_task(send(uid))))
+        results = await asyncio.gather(*(t for _, t in tasks))
+        blocked = [uid for (uid, _), res in zip(tasks, results) if res == "blocked"]
+        if blocked:
+            await db_write(_mark_blocked, blocked)
+        METRICS.inc("bot_bonus_reminders_total", (), results.count("sent"))
+        last_ts, last_id = rows[-1][1], rows[-1][0]
+
+def _stored_remind_cursor(now: float) -> float:
+    try:
+        cursor = float(get_setting("remind_cursor") or now)
+    except ValueError:
+        cursor = now
+    return min(max(cursor, now - REMIND_LOOKBACK), now)
+
+async def remind_bonus_job(context: BotContext):
+    now = time.time()
+    start = _REMIND_CURSOR[0] or _stored_remind_cursor(now)
+    end = max(start, now) + REMIND_INTERVAL
+    # stored as the start of the window in flight: a restart mid-window repeats
+    # it rather than dropping the reminders it had not sent yet
+    await set_setting("remind_cursor", str(int(start)))
+    _REMIND_CURSOR[0] = end
+    task = asyncio.create_task(send_reminders(context.application, start, end))
+    _REMINDERS.add(task)
+    task.add_done_callback(_REMINDERS.discard)
+
+async def stop_reminders():
+    tasks = list(_REMINDERS)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ========= WITHDRAW QUEUE =========
+# Pending requests are paged with a keyset cursor over (status, created_at, id),
+# so each page is an index range scan however large the table gets. A cursor
+# is just the id of the last row on the previous page.
+WD_PAGE = 10
+
+_WD_PAGE_FIRST = ("SELECT id, user_id, amount, wallet, created_at FROM withdraw_requests "
+                  "WHERE status='pending' ORDER BY created_at, id LIMIT ?")
+_WD_PAGE_AFTER = ("SELECT id, user_id, amount, wallet, created_at FROM withdraw_requests "
+                  "WHERE status='pending' AND (created_at, id) > "
+                  "(SELECT created_at, id FROM withdraw_requests WHERE id=?) "
+                  "ORDER BY created_at, id LIMIT ?")
+
+async def pending_withdrawals(after_id: int = 0, limit: int = WD_PAGE) -> list:
+    if after_id:
+        return await db_fetchall(_WD_PAGE_AFTER, (after_id, limit))
+    return await db_fetchall(_WD_PAGE_FIRST, (limit,))
+
+def _review_withdrawals(conn: sqlite3.Connection, approve: bool, rows: list) -> Tuple[int, int]:
+    """Approve (debit + mark) or reject the given pending rows; returns (done, skipped)."""
+    now = int(time.time())
+    done = skipped = 0
+    for wd_id, user_id, amount in rows:
+        if approve:
+            bal = conn.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()
+            if not bal or bal[0] < amount:
+                skipped += 1
+                continue
+            _apply_ledger(conn, user_id, -amount, REASON_WITHDRAW)
+        conn.execute("UPDATE withdraw_requests SET status=?, processed_at=? WHERE id=? AND status='pending'",
+                     ("approved" if approve else "rejected", now, wd_id))
+        done += 1
+    return done, skipped
+
+def _review_window(conn: sqlite3.Connection, approve: bool, after_id: int, last_id: int) -> Tuple[int, int]:
+    # Re-select inside the transaction so rows handled meanwhile are left alone.
+    if after_id:
+        rows = conn.execute(
+            "SELECT id, user_id, amount FROM withdraw_requests WHERE status='pending' "
+            "AND (created_at, id) > (SELECT created_at, id FROM withdraw_requests WHERE id=?) "
+            "AND (created_at, id) <= (SELECT created_at, id FROM withdraw_requests WHERE id=?)",
+            (after_id, last_id)).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT id, user_id, amount FROM withdraw_requests WHERE status='pending' "
+            "AND (created_at, id) <= (SELECT created_at, id FROM withdraw_requests WHERE id=?)",
+            (last_id,)).fetchall()
+    return _review_withdrawals(conn, approve, rows)
+
+def _review_one(conn: sqlite3.Connection, approve: bool, wd_id: int) -> Tuple[int, int]:
+    rows = conn.execute("SELECT id, user_id, amount FROM withdraw_requests WHERE id=? AND status='pending'",
+                        (wd_id,)).fetchall()
+    return _review_withdrawals(conn, approve, rows)
+
+async def review_page(approve: bool, after_id: int, last_id: int) -> Tuple[int, int]:
+    return await db_write(_review_window, approve, after_id, last_id)
+
+async def review_one(approve: bool, wd_id: int) -> Tuple[int, int]:
+    return await db_write(_review_one, approve, wd_id)
+
+async def withdraw_queue_view(after_id: int = 0) -> Tuple[str, InlineKeyboardMarkup]:
+    rows = await pending_withdrawals(after_id)
+    if not rows:
+        text = "🧾 Withdrawal queue\n\nNo pending requests" + (" after this point." if after_id else ".")
+        kb = [[InlineKeyboardButton("⏮ First page", callback_data="admin:wdq:0")]] if after_id else []
+        kb.append([InlineKeyboardButton("⬅️ Panel", callback_data="admin:panel")])
+        return text, InlineKeyboardMarkup(kb)
+    lines = ["🧾 Withdrawal queue (oldest first)", ""]
+    kb = []
+    for wd_id, user_id, amount, wallet, created_at in rows:
+        lines.append(f"#{wd_id} • user {user_id} • {fmt_amount(to_major(amount))}\n   {wallet} • {fmt_ts(created_at)}")
+        kb.append([InlineKeyboardButton(f"✅ #{wd_id}", callback_data=f"admin:wd_ok:{wd_id}:{after_id}"),
+                   InlineKeyboardButton(f"❌ #{wd_id}", callback_data=f"admin:wd_no:{wd_id}:{after_id}")])
+    last_id = rows[-1][0]
+    kb.append([InlineKeyboardButton("✅ Approve page", callback_data=f"admin:wdq_ok:{after_id}:{last_id}"),
+               InlineKeyboardButton("❌ Reject page", callback_data=f"admin:wdq_no:{after_id}:{last_id}")])
+    nav = []
+    if after_id:
+        nav.append(InlineKeyboardButton("⏮ First", callback_data="admin:wdq:0"))
+    if len(rows) == WD_PAGE:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin:wdq:{last_id}"))
+    nav.append(InlineKeyboardButton("⬅️ Panel", callback_data="admin:panel"))
+    kb.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+async def withdraw_history_text(user_id: int, limit: int = 15) -> str:
+    # processed requests move to withdraw_archive after ARCHIVE_AFTER_DAYS (see MAINTENANCE)
+    rows = await db_fetchall(
+        "SELECT id, amount, wallet, status, created_at FROM withdraw_requests WHERE user_id=? "
+        f"UNION ALL SELECT id, amount, wallet, status, created_at FROM {_archive_schema()}.withdraw_archive "
+        "WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (user_id, user_id, limit))
+    if not rows:
+        return f"No withdrawal requests for {user_id}."
+    lines = [f"Withdrawals for {user_id} (latest {len(rows)}):"]
+    for wd_id, amount, wallet, status, created_at in rows:
+        lines.append(f"#{wd_id} • {fmt_amount(to_major(amount))} • {status} • {fmt_ts(created_at)} • {wallet}")
+    return "\n".join(lines)
+
+# ========= ADMIN DIGEST =========
+# New withdrawal requests are not announced one message at a time. They queue
+# up and go to the admin as one digest after DIGEST_INTERVAL seconds or
+# DIGEST_MAX requests, whichever comes first. A send that fails for a network
+# reason is retried with exponential backoff; if it still fails, the items roll
+# into the next digest. A rejected send (bad request, admin blocked the bot) is
+# dropped instead so it can't hold up later digests; the queue still lists them.
+DIGEST_INTERVAL = 60.0
+DIGEST_MAX = 25
+DIGEST_SHOW = 10       # requests listed individually in one digest
+DIGEST_RETRIES = 5
+DIGEST_BACKOFF = 2.0   # seconds, doubled per attempt
+
+def digest_text(items: list) -> str:
+    total = sum(amount for _, amount, _ in items)
+    lines = [f"🆕 *Withdraw Requests*: {len(items)} new, total *{fmt_amount(total)}*"]
+    # wallets are user text: escaped, and outside a code span where escapes don't apply
+    lines += [f"• `{uid}` {fmt_amount(amount)} → {escape_markdown(wallet, version=1)}"
+              for uid, amount, wallet in items[:DIGEST_SHOW]]
+    if len(items) > DIGEST_SHOW:
+        lines.append(f"…and {len(items) - DIGEST_SHOW} more")
+    return "\n".join(lines)
+
+DIGEST_KB = InlineKeyboardMarkup([[InlineKeyboardButton("📋 Review queue", callback_data="admin:wdq:0")]])
+
+class WithdrawDigest:
+    def __init__(self, interval: float = DIGEST_INTERVAL, max_items: int = DIGEST_MAX):
+        self.interval = interval
+        self.max_items = max_items
+        self._items = []  # (user id, amount, wallet)
+        self._bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._first: Optional[asyncio.Event] = None  # set while items are waiting
+        self._full: Optional[asyncio.Event] = None   # set once max_items are waiting
+        self._closing = False
+
+    def add(self, bot, user_id: int, amount: float, wallet: str):
+        if self._task is None:
+            self._bot = bot
+            self._first, self._full = asyncio.Event(), asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._items.append((user_id, amount, wallet))
+        self._first.set()
+        if len(self._items) >= self.max_items:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            await self._first.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            items, self._items = self._items, []
+            self._first.clear()
+            self._full.clear()
+            if items and not await self._deliver(items) and not self._closing:
+                self._items[:0] = items
+                self._first.set()
+            if self._closing:
+                return
+
+    async def _deliver(self, items: list) -> bool:
+        chat_id = admin_id()
+        if not chat_id:
+            return True  # nobody to tell; the queue still lists them
+        delay = DIGEST_BACKOFF
+        for attempt in range(DIGEST_RETRIES):
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=digest_text(items),
+                                             parse_mode=ParseMode.MARKDOWN, reply_markup=DIGEST_KB,
+                                             rate_limit_args=PRIO_BULK)
+                METRICS.inc("bot_admin_digests_total", ())
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+            except TelegramError as e:
+                if isinstance(e, BadRequest) or not isinstance(e, NetworkError):
+                    print(f"Withdraw digest rejected, dropping {len(items)} item(s): {e}")
+                    METRICS.inc("bot_admin_digest_failures_total", ())
+                    return True
+                print(f"Withdraw digest failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+        METRICS.inc("bot_admin_digest_failures_total", ())
+        return False
+
+    async def close(self, timeout: float = 10.0):
+        """Send whatever is still queued (one last attempt), then stop."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._first.set()
+        self._full.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._task = None
+        self._closing = False
+
+WD_DIGEST = _PerBot("digest")
+
+# ========= BULK IMPORT =========
+# Admins can upload a CSV/TSV of balance adjustments and bans. The file is read
+# as a stream on the DB executor, every row is validated, valid rows are
+# applied in chunks with executemany (one transaction per chunk) and rejected
+# rows are written to an error file that is sent back with the summary.
+#
+# Row formats (optional header line; comma, semicolon or tab separated):
+#   user_id,amount          signed balance adjustment
+#   user_id,add,amount      /  user_id,remove,amount
+#   user_id,ban             /  user_id,unban
+IMPORT_CHUNK = 1000
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # Bot API download limit
+
+def _parse_import_row(row: list) -> Tuple[int, str, float]:
+    cells = [c.strip() for c in row]
+    while cells and not cells[-1]:
+        cells.pop()
+    if not cells:
+        raise ValueError("empty row")
+    try:
+        uid = int(cells[0])
+    except ValueError:
+        raise ValueError("user_id must be an integer")
+    if uid <= 0:
+        raise ValueError("user_id must be positive")
+    if uid > MAX_MINOR:  # same SQLite INTEGER bound
+        raise ValueError("user_id out of range")
+    if len(cells) == 2 and cells[1].lower() in ("ban", "unban"):
+        return uid, "ban", 1.0 if cells[1].lower() == "ban" else 0.0
+    if len(cells) == 2:
+        op, raw = "", cells[1]
+    elif len(cells) == 3 and cells[1].lower() in ("add", "remove"):
+        op, raw = cells[1].lower(), cells[2]
+    else:
+        raise ValueError("expected user_id,amount | user_id,add|remove,amount | user_id,ban|unban")
+    try:
+        amount = parse_amount(raw)
+    except ValueError:
+        raise ValueError("amount must be a finite number in range")
+    if op:
+        if amount < 0:
+            raise ValueError("use a positive amount with add/remove")
+        amount = amount if op == "add" else -amount
+    if amount == 0:
+        raise ValueError("amount is zero")
+    return uid, "balance", amount
+
+def _apply_import_chunk(conn: sqlite3.Connection, ops: list):
+    now = int(time.time())
+    conn.executemany("INSERT OR IGNORE INTO users(id, created_at) VALUES(?,?)",
+                     [(uid, now) for uid in {op[0] for op in ops}])
+    deltas = [(uid, to_minor(v)) for uid, kind, v in ops if kind == "balance"]
+    if deltas:
+        conn.executemany("UPDATE users SET balance = balance + ? WHERE id=?", [(v, uid) for uid, v in deltas])
+        conn.executemany(
+            "INSERT INTO ledger(user_id, delta, reason, created_at) VALUES(?,?,?,?)",
+            [(uid, v, REASON_ADMIN_ADD if v > 0 else REASON_ADMIN_REMOVE, now) for uid, v in deltas])
+    bans = [(int(v), uid) for uid, kind, v in ops if kind == "ban"]
+    if bans:
+        conn.executemany("UPDATE users SET is_banned=? WHERE id=?", bans)
+
+def _run_import(path: str, errors_path: str) -> dict:
+    """Blocking; runs on the DB executor. Memory use is bounded by IMPORT_CHUNK."""
+    summary = {"rows": 0, "credited": 0.0, "debited": 0.0, "adjustments": 0, "bans": 0, "unbans": 0, "errors": 0,
+               "failed_chunks": 0}
+
+    def apply(chunk: list):
+        # a chunk that fails rolls back as a whole; its rows go to the error file
+        try:
+            DB.run_in_transaction(_apply_import_chunk, [op for op, _, _ in chunk])
+        except Exception as e:
+            summary["failed_chunks"] += 1
+            summary["errors"] += len(chunk)
+            for _, lineno, raw in chunk:
+                errors.writerow([lineno, f"chunk not applied: {e}", raw])
+            return
+        for (uid, kind, v), _, _ in chunk:
+            summary["rows"] += 1
+            if kind == "balance":
+                summary["adjustments"] += 1
+                summary["credited" if v > 0 else "debited"] += abs(v)
+            else:
+                summary["bans" if v else "unbans"] += 1
+                # committed; plain set ops from the DB executor are safe under the GIL
+                if v:
+                    BANNED.add(uid)
+                else:
+                    BANNED.discard(uid)
+
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as fh, \
+            open(errors_path, "w", newline="", encoding="utf-8") as errf:
+        first = fh.readline()
+        delimiter = "\t" if "\t" in first else (";" if ";" in first and "," not in first else ",")
+        fh.seek(0)
+        errors = csv.writer(errf)
+        errors.writerow(["line", "error", "row"])
+        chunk = []
+        for lineno, row in enumerate(csv.reader(fh, delimiter=delimiter), 1):
+            if not any(c.strip() for c in row):
+                continue
+            try:
+                op = _parse_import_row(row)
+            except ValueError as e:
+                if lineno == 1:
+                    continue  # header
+                summary["errors"] += 1
+                errors.writerow([lineno, str(e), delimiter.join(row)])
+                continue
+            chunk.append((op, lineno, delimiter.join(row)))
+            if len(chunk) >= IMPORT_CHUNK:
+                apply(chunk)
+                chunk = []
+        if chunk:
+            apply(chunk)
+    return summary
+
+async def on_document(update: Update, context: BotContext):
+    awaitable = context.user_data.get("await")
+    if not awaitable or awaitable[0] != "bulk_import" or not is_admin(update.effective_user.id):
+        return
+    doc = update.message.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("File too large (max 20 MB).")
+        return
+    await update.message.reply_text("⏳ Importing…")
+    t0 = time.monotonic()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            src_path = os.path.join(tmp, "import.csv")
+            err_path = os.path.join(tmp, "import_errors.csv")
+            try:
+                tg_file = await context.bot.get_file(doc.file_id)
+                await tg_file.download_to_drive(src_path)
+                s = await DB.run(_run_import, src_path, err_path)
+            except Exception as e:
+                await update.message.reply_text(f"❌ Import failed: {e}")
+                return
+            failed = f" ({s['failed_chunks']:,} chunk(s) not applied)" if s["failed_chunks"] else ""
+            await update.message.reply_text(
+                f"✅ Import done in {time.monotonic() - t0:.1f}s\n"
+                f"Rows applied: {s['rows']:,}\n"
+                f"Balance adjustments: {s['adjustments']:,} (+{fmt_amount(s['credited'])} / -{fmt_amount(s['debited'])})\n"
+                f"Bans: {s['bans']:,} | Unbans: {s['unbans']:,}\n"
+                f"Rejected rows: {s['errors']:,}{failed}")
+            if s["errors"]:
+                with open(err_path, "rb") as fh:
+                    await update.message.reply_document(document=fh, filename="import_errors.csv")
+    finally:
+        context.user_data.pop("await", None)
+
+# ========= EXPORT =========
+# /export streams a table from its own read-only snapshot connection, gzips it
+# on the fly into a spooled temp file (spills to disk past EXPORT_SPOOL bytes)
+# and sends the result as a document. Rows are fetched EXPORT_BATCH at a time,
+# so memory stays flat however large the table is.
+EXPORT_BATCH = 1000
+EXPORT_SPOOL = 4 * 1024 * 1024
+# money columns are exported in major units; timestamps stay unix seconds
+EXPORT_TABLES = {
+    "users": f"SELECT id, balance / {MINOR_UNITS}.0 AS balance, is_banned, ref_by, created_at, last_bonus_ts, "
+             "passed_join_check, ref_credit_given, is_blocked, bonus_remind FROM users ORDER BY id",
+    "withdrawals": f"SELECT id, user_id, amount / {MINOR_UNITS}.0 AS amount, wallet, status, created_at, "
+                   "processed_at FROM withdraw_requests ORDER BY id",
+    "withdrawals_archive": f"SELECT id, user_id, amount / {MINOR_UNITS}.0 AS amount, wallet, status, created_at, "
+                           "processed_at, archived_at FROM {archive}.withdraw_archive ORDER BY id",
+    "ledger": f"SELECT id, user_id, delta / {MINOR_UNITS}.0 AS delta, reason, created_at FROM ledger ORDER BY id",
+}
+EXPORT_FORMATS = ("csv", "jsonl")
+
+def _export_table(name: str, fmt: str):
+    """Blocking; runs on the DB executor. Returns (spooled gzip file, row count)."""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL)
+    rows = 0
+    with DB.snapshot() as conn:
+        cur = conn.execute(EXPORT_TABLES[name].replace("{archive}", _archive_schema()))
+        cols = [d[0] for d in cur.description]
+        with gzip.GzipFile(filename=f"{name}.{fmt}", mode="wb", fileobj=spool) as gz, \
+                io.TextIOWrapper(gz, encoding="utf-8", newline="") as out:
+            writer = csv.writer(out) if fmt == "csv" else None
+            if writer:
+                writer.writerow(cols)
+            while True:
+                batch = cur.fetchmany(EXPORT_BATCH)
+                if not batch:
+                    break
+                rows += len(batch)
+                if writer:
+                    writer.writerows(batch)
+                else:
+                    out.writelines(json.dumps(dict(zip(cols, r)), ensure_ascii=False) + "\n" for r in batch)
+    spool.seek(0)
+    return spool, rows
+
+async def cmd_export(update: Update, context: BotContext):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You are not an admin.")
+        return
+    args = [a.lower() for a in (context.args or [])]
+    fmt = next((a for a in args if a in EXPORT_FORMATS), "csv")
+    names = [a for a in args if a in EXPORT_TABLES] or list(EXPORT_TABLES)
+    unknown = [a for a in args if a not in EXPORT_TABLES and a not in EXPORT_FORMATS]
+    if unknown:
+        await update.message.reply_text(
+            f"Usage: /export [{'|'.join(EXPORT_TABLES)}] [{'|'.join(EXPORT_FORMATS)}]")
+        return
+    stamp = time.strftime("%Y%m%d-%H%M", time.gmtime())
+    for name in names:
+        spool, rows = await DB.run(_export_table, name, fmt)
+        with spool:
+            await update.message.reply_document(
+                document=spool, filename=f"{name}-{stamp}.{fmt}.gz", caption=f"{name}: {rows:,} rows")
+
+# ========= MAINTENANCE =========
+# A job-queue pass every MAINT_INTERVAL seconds keeps a long-running bot.db
+# from growing without bound: a PASSIVE WAL checkpoint (TRUNCATE once writes
+# have been quiet for MAINT_QUIET seconds), archival of processed withdrawals
+# older than ARCHIVE_AFTER_DAYS, and a few small incremental-vacuum steps.
+# Archive and vacuum work goes through the group committer in short batches
+# with a pause between them, so handler writes interleave. /db reports sizes.
+MAINT_INTERVAL = 300
+MAINT_QUIET = 60.0
+ARCHIVE_BATCH = 500
+ARCHIVE_MAX_BATCHES = 20   # per pass; a large backlog drains over several passes
+VACUUM_PAGES = 256         # pages released per incremental step
+VACUUM_MAX_STEPS = 8
+MAINT_PAUSE = 0.05         # seconds between batches
+
+_MAINT = _PerBot("maint")  # last pass: at, checkpoint, archived, freed; running
+
+def _archive_schema() -> str:
+    return "archive" if DB.archive_path else "main"
+
+def _ensure_withdraw_archive(conn: sqlite3.Connection):
+    # created up front so history and export can always read it alongside withdraw_requests
+    schema = _archive_schema()
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.withdraw_archive(
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            wallet TEXT,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            processed_at INTEGER,
+            archived_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_wd_archive_user ON withdraw_archive(user_id, id)")
+
+def _archive_copy(conn: sqlite3.Connection, cutoff: int, limit: int) -> list:
+    schema = _archive_schema()
+    _ensure_withdraw_archive(conn)
+    ids = [r[0] for r in conn.execute(
+        "SELECT id FROM withdraw_requests WHERE status IN ('approved', 'rejected') AND created_at < ? "
+        "AND COALESCE(processed_at, created_at) < ? LIMIT ?", (cutoff, cutoff, limit))]
+    if ids:
+        marks = ",".join("?" * len(ids))
+        conn.execute(f"INSERT OR REPLACE INTO {schema}.withdraw_archive "
+                     f"SELECT id, user_id, amount, wallet, status, created_at, processed_at, ? "
+                     f"FROM withdraw_requests WHERE id IN ({marks})", (int(time.time()), *ids))
+    return ids
+
+def _archive_delete(conn: sqlite3.Connection, ids: list):
+    conn.execute(f"DELETE FROM withdraw_requests WHERE id IN ({','.join('?' * len(ids))})", ids)
+
+def _vacuum_step(conn: sqlite3.Connection, pages: int) -> int:
+    """Release up to `pages` free pages; returns how many free pages are left."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    # the sqlite3 module steps a row-less PRAGMA once, and each step frees one page
+    for _ in range(pages):
+        conn.execute("PRAGMA incremental_vacuum")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+async def run_maintenance():
+    if _MAINT["running"]:
+        return
+    _MAINT["running"] = True
+    try:
+        quiet = time.monotonic() - WRITER.last_commit >= MAINT_QUIET
+        mode = "TRUNCATE" if quiet else "PASSIVE"
+        _MAINT["checkpoint"] = (mode,) + await DB.run(DB.checkpoint, mode)
+
+        # Copy and delete commit separately: with an attached archive file the
+        # two aren't atomic together, and a crash in between only leaves a row
+        # that the next pass copies again (INSERT OR REPLACE) and then deletes.
+        cutoff = int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+        archived = 0
+        for _ in range(ARCHIVE_MAX_BATCHES):
+            ids = await db_write(_archive_copy, cutoff, ARCHIVE_BATCH)
+            if ids:
+                await db_write(_archive_delete, ids)
+                archived += len(ids)
+            if len(ids) < ARCHIVE_BATCH:
+                break
+            await asyncio.sleep(MAINT_PAUSE)
+
+        before = await db_fetchone("PRAGMA freelist_count")
+        left = before[0]
+        for _ in range(VACUUM_MAX_STEPS):
+            if not left:
+                break
+            left = await db_write(_vacuum_step, VACUUM_PAGES)
+            await asyncio.sleep(MAINT_PAUSE)
+
+        _MAINT.update(at=time.time(), archived=archived, freed=before[0] - left)
+        METRICS.inc("bot_db_archived_total", (), archived)
+    finally:
+        _MAINT["running"] = False
+
+async def maintenance_job(context: BotContext):
+    await run_maintenance()
+
+def _db_info() -> dict:
+    """Blocking; runs on the DB executor."""
+    info = {"size": os.path.getsize(DB.path), "wal": 0, "archive_size": 0}
+    if os.path.exists(DB.path + "-wal"):
+        info["wal"] = os.path.getsize(DB.path + "-wal")
+    if DB.archive_path and os.path.exists(DB.archive_path):
+        info["archive_size"] = os.path.getsize(DB.archive_path)
+    for pragma in ("page_size", "page_count", "freelist_count", "auto_vacuum"):
+        info[pragma] = DB.fetchone(f"PRAGMA {pragma}")[0]
+    info["withdrawals"] = DB.fetchone("SELECT COUNT(*) FROM withdraw_requests")[0]
+    info["archived"] = DB.fetchone(f"SELECT COUNT(*) FROM {_archive_schema()}.withdraw_archive")[0]
+    return info
+
+def _fmt_bytes(n: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:,.0f} {unit}" if unit == "B" else f"{n:,.1f} {unit}"
+        n /= 1024
+
+async def cmd_db(update: Update, context: BotContext):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You are not an admin.")
+        return
+    if context.args and context.args[0].lower() == "vacuum":
+        await update.message.reply_text("⏳ Running full VACUUM (writes wait until it finishes)…")
+        t0 = time.monotonic()
+        await DB.run(DB.vacuum)
+        await update.message.reply_text(f"✅ VACUUM done in {time.monotonic() - t0:.1f}s.")
+        return
+    i = await DB.run(_db_info)
+    frag = i["freelist_count"] / i["page_count"] * 100 if i["page_count"] else 0.0
+    mode = {0: "none", 1: "full", 2: "incremental"}.get(i["auto_vacuum"], "?")
+    lines = ["🗄 Database",
+             f"File: {_fmt_bytes(i['size'])} + WAL {_fmt_bytes(i['wal'])}",
+             f"Pages: {i['page_count']:,} × {i['page_size']} B, free {i['freelist_count']:,} ({frag:.1f}% fragmentation)",
+             f"auto_vacuum: {mode}" + ("" if mode == "incremental" else " — send /db vacuum once to enable"),
+             f"Withdrawals: {i['withdrawals']:,} live, {i['archived']:,} archived"
+             + (f" ({_fmt_bytes(i['archive_size'])} in {DB.archive_path})" if DB.archive_path else "")]
+    if _MAINT["at"]:
+        ago = int(time.time() - _MAINT["at"])
+        mode, busy, log, done = _MAINT["checkpoint"]
+        lines.append(f"Last maintenance {ago // 60}m{ago % 60:02d}s ago: checkpoint {mode} {done}/{log} frames"
+                     f"{' (busy)' if busy else ''}, archived {_MAINT['archived']:,}, freed {_MAINT['freed']:,} pages")
+    await update.message.reply_text("\n".join(lines))
+
+# ========= DASHBOARD =========
+# /dashboard only reads three small summary tables, so it answers at once.
+# A job refreshes them every DASH_INTERVAL seconds from its own read-only
+# snapshot (DB.snapshot): no reader-pool connection, no write lock, and in WAL
+# mode no wait on writers. Only the resulting rows go through the group
+# committer. Refreshes are incremental: ledger rows past the stored ledger id
+# give the liabilities delta and the per-day bonus/referral/credit/withdrawal
+# counts, and users created since the stored timestamp (idx_users_created,
+# DASH_SLACK seconds behind so in-flight inserts aren't skipped) give sign-ups.
+# Join-check passes and blocked users have no watermark; a full pass over
+# users every DASH_FULL_EVERY seconds recounts them and re-bases the totals.
+# Pending withdrawals are regrouped on each refresh through idx_wd_status_created.
+DASH_INTERVAL = 300
+DASH_FULL_EVERY = 3600
+DASH_SLACK = 60
+DASH_DAYS = 7
+DASH_WD_BANDS = (1_000, 10_000, 100_000)  # pending withdrawal amount bands (major units)
+
+_DASH_LEDGER = ("SELECT created_at / 86400 AS day, SUM(reason = ?), SUM(reason = ?), "
+                "SUM(CASE WHEN delta > 0 THEN delta ELSE 0 END), "
+                "SUM(CASE WHEN reason = ? THEN -delta ELSE 0 END), SUM(delta) "
+                "FROM ledger WHERE id > ? AND id <= ? GROUP BY day")
+_DASH_USERS = ("SELECT created_at / 86400 AS day, COUNT(*) FROM users "
+               "WHERE created_at >= ? AND created_at < ? GROUP BY day")
+_DASH_FULL = ("SELECT SUM(COALESCE(created_at, 0) < ?), COALESCE(SUM(balance), 0), "
+              "COALESCE(SUM(passed_join_check), 0), COALESCE(SUM(is_blocked), 0) FROM users")
+_DASH_PENDING = ("SELECT CASE " + " ".join(f"WHEN amount < ? THEN {i}" for i in range(len(DASH_WD_BANDS)))
+                 + f" ELSE {len(DASH_WD_BANDS)} END AS band, COUNT(*), SUM(amount) "
+                 "FROM withdraw_requests WHERE status='pending' GROUP BY band")
+_DASH_DAILY_ADD = ("INSERT INTO dashboard_daily(day, new_users, bonus_claims, referrals, credited, withdrawn) "
+                   "VALUES(?,?,?,?,?,?) ON CONFLICT(day) DO UPDATE SET "
+                   "new_users=new_users+excluded.new_users, bonus_claims=bonus_claims+excluded.bonus_claims, "
+                   "referrals=referrals+excluded.referrals, credited=credited+excluded.credited, "
+                   "withdrawn=withdrawn+excluded.withdrawn")
+
+def _ledger_id_before(conn: sqlite3.Connection, ts: int) -> int:
+    """Highest ledger id created before `ts`; ids grow with created_at, so bisect on id."""
+    lo, hi = 0, conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        row = conn.execute("SELECT created_at FROM ledger WHERE id <= ? ORDER BY id DESC LIMIT 1", (mid,)).fetchone()
+        if row is None or (row[0] or 0) < ts:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _dashboard_delta() -> tuple:
+    """Blocking; runs on the DB executor. Returns the arguments for _save_dashboard."""
+    now = int(time.time())
+    cutoff = now - DASH_SLACK
+    first_day = now // 86400 - DASH_DAYS + 1
+    with DB.snapshot() as conn:
+        totals = dict(conn.execute("SELECT key, value FROM dashboard_totals"))
+        expect = (totals.get("ledger_id"), totals.get("users_ts"))
+        if "ledger_id" in totals:
+            since_id, since_ts = totals["ledger_id"], totals["users_ts"]
+        else:  # first refresh: only the daily window needs history
+            since_id, since_ts = _ledger_id_before(conn, first_day * 86400), first_day * 86400
+        top = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+
+        daily = {}  # day -> [new users, bonus claims, referrals, credited, withdrawn]
+        net = joined = 0
+        for day, bonus, refs, credited, withdrawn, delta in conn.execute(
+                _DASH_LEDGER, (REASON_DAILY_BONUS, REASON_REFERRAL, REASON_WITHDRAW, since_id, top)):
+            daily[day] = [0, bonus, refs, credited, withdrawn]
+            net += delta
+        for day, n in conn.execute(_DASH_USERS, (since_ts, cutoff)):
+            daily.setdefault(day, [0, 0, 0, 0, 0])[0] = n
+            joined += n
+
+        new = {"ledger_id": top, "users_ts": cutoff, "refreshed_at": now}
+        if now - totals.get("full_at", 0) >= DASH_FULL_EVERY:
+            users, balance, passed, blocked = conn.execute(_DASH_FULL, (cutoff,)).fetchone()
+            new.update(users=users or 0, liabilities=balance, passed=passed, blocked=blocked, full_at=now)
+        else:
+            new.update(users=totals["users"] + joined, liabilities=totals["liabilities"] + net)
+        pending = conn.execute(_DASH_PENDING, [to_minor(b) for b in DASH_WD_BANDS]).fetchall()
+    rows = [(day, *v) for day, v in sorted(daily.items()) if day >= first_day]
+    return expect, new, rows, pending, first_day
+
+def _save_dashboard(conn: sqlite3.Connection, expect: tuple, totals: dict, daily: list, pending: list,
+                    first_day: int) -> bool:
+    marks = dict(conn.execute("SELECT key, value FROM dashboard_totals WHERE key IN ('ledger_id', 'users_ts')"))
+    if (marks.get("ledger_id"), marks.get("users_ts")) != expect:
+        return False  # another refresh saved first; its deltas already cover these
+    conn.executemany("REPLACE INTO dashboard_totals(key, value) VALUES(?,?)", totals.items())
+    conn.executemany(_DASH_DAILY_ADD, daily)
+    conn.execute("DELETE FROM dashboard_daily WHERE day < ?", (first_day,))
+    conn.execute("DELETE FROM dashboard_pending")
+    conn.executemany("INSERT INTO dashboard_pending(band, requests, amount) VALUES(?,?,?)", pending)
+    return True
+
+async def refresh_dashboard() -> bool:
+    t0 = time.perf_counter()
+    saved = await db_write(_save_dashboard, *await DB.run(_dashboard_delta))
+    METRICS.observe("bot_dashboard_refresh_seconds", (), time.perf_counter() - t0)
+    return saved
+
+async def dashboard_job(context: BotContext):
+    await refresh_dashboard()
+
+def _band_label(band: int) -> str:
+    if band == 0:
+        return f"< {fmt_amount(DASH_WD_BANDS[0])}"
+    if band == len(DASH_WD_BANDS):
+        return f"≥ {fmt_amount(DASH_WD_BANDS[-1])}"
+    return f"{fmt_amount(DASH_WD_BANDS[band - 1])} – {fmt_amount(DASH_WD_BANDS[band])}"
+
+async def dashboard_text() -> str:
+    totals = dict(await db_fetchall("SELECT key, value FROM dashboard_totals"))
+    if "refreshed_at" not in totals:
+        return "📈 Dashboard\n\nNot computed yet. Send /dashboard refresh or try again in a minute."
+    days = await db_fetchall("SELECT day, new_users, bonus_claims, referrals, credited, withdrawn "
+                             "FROM dashboard_daily ORDER BY day DESC LIMIT ?", (DASH_DAYS,))
+    pending = await db_fetchall("SELECT band, requests, amount FROM dashboard_pending ORDER BY band")
+    users = totals["users"]
+    rate = totals["passed"] / users * 100 if users else 0.0
+    lines = [f"📈 Dashboard (as of {fmt_ts(totals['refreshed_at'])} UTC)",
+             f"Users: {users:,} • join-check passed {rate:.1f}% • blocked {totals['blocked']:,} • banned {len(BANNED):,}",
+             f"Liabilities: {fmt_amount(to_major(totals['liabilities']))}",
+             f"Pending withdrawals: {sum(r[1] for r in pending):,} • "
+             f"{fmt_amount(to_major(sum(r[2] for r in pending)))}"]
+    lines += [f"  {_band_label(band)}: {n:,} • {fmt_amount(to_major(amount))}" for band, n, amount in pending]
+    lines.append(f"\nLast {DASH_DAYS} days (UTC): new users / bonus claims / referrals / credited / withdrawn")
+    for day, new_users, bonus, refs, credited, withdrawn in days:
+        lines.append(f"{time.strftime('%m-%d', time.gmtime(day * 86400))}: {new_users:,} / {bonus:,} / {refs:,} / "
+                     f"{fmt_amount(to_major(credited))} / {fmt_amount(to_major(withdrawn))}")
+    if not days:
+        lines.append("No activity yet.")
+    return "\n".join(lines)
+
+async def cmd_dashboard(update: Update, context: BotContext):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You are not an admin.")
+        return
+    if context.args and context.args[0].lower() == "refresh":
+        await refresh_dashboard()
+    await update.message.reply_text(await dashboard_text())
+
 # ========= COMMANDS =========
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cmd_start(update: Update, context: BotContext):
     user = update.effective_user
     # parse referral (payload after /start)
     ref_by = None
@@ -261,10 +2276,12 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             ref_by = None
 
-    add_user_if_not_exists(user.id, ref_by)
-    if is_banned(user.id):
-        await update.message.reply_text("You are banned from using this bot.")
-        return
+    await add_user_if_not_exists(user.id, ref_by)
+    rec = await load_user(context, user.id)
+    if rec.is_blocked:
+        # they unblocked the bot; include them in broadcasts again
+        rec.set("is_blocked", False)
+        await save_user(rec)
 
     await send_user_home(update, context)
 
@@ -273,14 +2290,14 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # nothing to do now; bonus happens when they pass join check
         pass
 
-async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cmd_admin(update: Update, context: BotContext):
     uid = update.effective_user.id
     if not is_admin(uid):
         await update.message.reply_text("You are not an admin.")
         return
     await update.message.reply_text("🛠 *Admin Panel*", reply_markup=admin_panel_kb(), parse_mode=ParseMode.MARKDOWN)
 
-async def cmd_claimadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cmd_claimadmin(update: Update, context: BotContext):
     if admin_id():
         await update.message.reply_text("Admin already set.")
         return
@@ -289,326 +2306,878 @@ async def cmd_claimadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     pin = context.args[0]
     if pin == OWNER_CLAIM_PIN:
-        set_setting("admin_id", str(update.effective_user.id))
+        await set_setting("admin_id", str(update.effective_user.id))
         await update.message.reply_text("✅ You are now the admin. Use /admin to open the panel.")
     else:
         await update.message.reply_text("❌ Wrong PIN.")
 
-async def cmd_myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def _fmt_ms(seconds: float) -> str:
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:.1f}ms"
+
+async def cmd_stats(update: Update, context: BotContext):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You are not an admin.")
+        return
+    up = int(time.time() - METRICS.started)
+    lines = [f"📊 Stats (up {up // 3600}h{up % 3600 // 60:02d}m)"]
+
+    handlers = sorted(METRICS.series("bot_handler_seconds"), key=lambda s: -s[1].count)
+    total = sum(h.count for _, h in handlers)
+    lines.append(f"\nHandlers: {total:,} calls")
+    for labels, h in handlers[:10]:
+        name = labels["route"] or labels["handler"]
+        lines.append(f"• {name}: {h.count:,} × avg {_fmt_ms(h.total / h.count)}, p99 ≤ {_fmt_ms(h.quantile(0.99))}")
+
+    queries = METRICS.series("bot_db_query_seconds")
+    n = sum(h.count for _, h in queries)
+    t = sum(h.total for _, h in queries)
+    lines.append(f"\nDB: {n:,} statements, avg {_fmt_ms(t / n if n else 0.0)}")
+    for labels, h in sorted(queries, key=lambda s: -s[1].total)[:3]:
+        lines.append(f"• {labels['sql'][:60]}: {h.count:,} × avg {_fmt_ms(h.total / h.count)}")
+
+    api = [(lb, h) for lb, h in METRICS.series("bot_api_seconds") if lb["method"] != "getUpdates"]
+    n = sum(h.count for _, h in api)
+    t = sum(h.total for _, h in api)
+    errors = METRICS.counter_total("bot_api_errors_total")
+    retries = METRICS.counter_total("bot_api_retry_after_total")
+    lines.append(f"\nBot API: {n:,} calls, avg {_fmt_ms(t / n if n else 0.0)}, errors {errors}, 429s {retries}")
+    await update.message.reply_text("\n".join(lines))
+
+async def cmd_myid(update: Update, context: BotContext):
     await update.message.reply_text(f"Your ID: `{update.effective_user.id}`", parse_mode=ParseMode.MARKDOWN)
 
-# ========= USER CALLBACKS =========
-async def on_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cmd_cancel(update: Update, context: BotContext):
+    # drops whatever step the user was asked to type; persistence deletes the row
+    pending = context.user_data.pop("await", None)
+    await send_user_home(update, context, "Cancelled." if pending else None)
+
+# ========= ROUTER =========
+# Callback data is "<scope>:<action>[:<arg>...]", e.g. "admin:wd_ok:17:0", and
+# an awaited text step is context.user_data["await"] = (mode, ...). Every
+# (scope, action) and every mode maps to one handler, registered at import by
+# @callback_route / @text_route, so dispatch is a single dict lookup. Payload
+# arguments are decoded by the route's converters before the handler runs.
+# Admin and ban checks use the cached admin id and the in-memory ban list,
+# so routing itself never touches the database.
+class Route:
+    __slots__ = ("fn", "convert", "admin", "kwargs")
+
+    def __init__(self, fn: Callable, convert: tuple, admin: bool, kwargs: dict):
+        self.fn = fn
+        self.convert = convert
+        self.admin = admin
+        self.kwargs = kwargs
+
+CALLBACK_ROUTES = {}  # (scope, action) -> Route
+TEXT_ROUTES = {}      # awaited mode -> Route
+
+def callback_route(scope: str, action: str, *convert: Callable, **kwargs) -> Callable:
+    """Route "<scope>:<action>:<args>" to fn(update, context, *args, **kwargs); scope "admin" is admin-only."""
+    def register(fn: Callable) -> Callable:
+        CALLBACK_ROUTES[(scope, action)] = Route(fn, convert, scope == "admin", kwargs)
+        return fn
+    return register
+
+def text_route(mode: str, admin: bool = False, **kwargs) -> Callable:
+    """Route text sent while `mode` is awaited to fn(update, context, text, **kwargs)."""
+    def register(fn: Callable) -> Callable:
+        TEXT_ROUTES[mode] = Route(fn, (), admin, kwargs)
+        return fn
+    return register
+
+async def on_callback(update: Update, context: BotContext):
     q = update.callback_query
+    parts = (q.data or "").split(":")
+    route = CALLBACK_ROUTES.get(tuple(parts[:2]))
+    if route is None or len(parts) - 2 != len(route.convert):
+        await q.answer()  # stale or unknown button
+        return
     uid = q.from_user.id
-    if is_banned(uid):
-        await q.answer("You are banned.", show_alert=True)
-        return
-
-    data = q.data
-    if data == "user:bonus":
-        amt = float(get_setting("daily_bonus_amount") or "50")
-        last = get_last_bonus(uid)
-        now = datetime.utcnow()
-        if last and now - last < timedelta(days=1):
-            next_time = last + timedelta(days=1)
-            wait_h = int((next_time - now).total_seconds() // 3600) + 1
-            await q.answer("Come back later for your next daily bonus.", show_alert=True)
-        else:
-            change_balance(uid, amt)
-            set_last_bonus(uid, now)
-            await q.answer(f"🎁 Daily bonus added: {fmt_amount(amt)}", show_alert=True)
-        await send_user_home(update, context)
-
-    elif data == "user:reflink":
-        me = await context.bot.get_me()
-        link = f"https://t.me/{me.username}?start={uid}"
-        txt = ("👥 *Your Referral Link*\n"
-               f"{link}\n\n"
-               f"Reward per referral: *{fmt_amount(float(get_setting('referral_bonus_amount') or '100'))}*")
-        await q.edit_message_text(txt, parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_kb())
-
-    elif data == "user:channels":
-        await q.edit_message_text(channels_text(), parse_mode=ParseMode.MARKDOWN, reply_markup=channels_kb())
-
-    elif data == "user:joinedcheck":
-        ok = await check_user_joined_all(context, uid)
-        if ok:
-            if not has_passed_join_check(uid):
-                set_passed_join_check(uid)
-                # handle referral credit once
-                if not ref_credit_given(uid):
-                    ref = get_ref_by(uid)
-                    if ref:
-                        bonus = float(get_setting("referral_bonus_amount") or "100")
-                        change_balance(ref, bonus)
-                    set_ref_credit_given(uid)
-            await q.answer("✅ All set. Thanks!", show_alert=True)
-            await send_user_home(update, context, "✅ Join-check passed. You're good!")
-        else:
-            await q.answer("❌ You haven't joined all channels yet.", show_alert=True)
+    if route.admin and not is_admin(uid):
+        await q.answer("Not admin.", show_alert=True)
+        return
+    try:
+        args = [conv(raw) for conv, raw in zip(route.convert, parts[2:])]
+    except ValueError:
+        await q.answer()
+        return
+    await route.fn(update, context, *args, **route.kwargs)
 
-    elif data == "user:withdraw":
-        if get_setting("withdraw_open") != "1":
-            await q.answer("Withdrawals are currently OFF.", show_alert=True)
-            return
-        curbal = get_balance(uid)
-        mn = float(get_setting("min_withdraw") or "1000")
-        mx = float(get_setting("max_withdraw") or "500000")
-        txt = (f"💸 *Request Withdrawal*\n"
-               f"Balance: *{fmt_amount(curbal)}*\n"
-               f"Min: *{fmt_amount(mn)}*  |  Max: *{fmt_amount(mx)}*\n\n"
-               "Send your request in this format:\n"
-               "`amount wallet_or_account`\n"
-               "Example:\n"
-               "`2000 0123456789-AccessBank`\n"
-               "Or your crypto tag.\n\n"
-               "_Type /cancel to abort._")
-        context.user_data["await"] = ("withdraw_req",)
-        await q.edit_message_text(txt, parse_mode=ParseMode.MARKDOWN)
-
-    elif data == "user:help":
-        txt = ("*Help*\n"
-               "• Use the buttons to get bonus, referral link, channels and withdraw.\n"
-               "• Ask admin for support if needed.")
-        await q.edit_message_text(txt, parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_kb())
+async def on_text(update: Update, context: BotContext):
+    # Handle awaited inputs for admin or user withdrawal
+    awaitable = context.user_data.get("await")
+    uid = update.effective_user.id
+    route = TEXT_ROUTES.get(awaitable[0]) if awaitable else None
+    if route is not None and (not route.admin or is_admin(uid)):
+        await route.fn(update, context, (update.message.text or "").strip(), **route.kwargs)
+        return
 
-# ========= ADMIN PANEL CALLBACKS =========
-async def on_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # If no awaited action: basic echo/help for normal users (ignore commands handled elsewhere)
+    if not is_admin(uid):
+        await send_user_home(update, context, "Hello! Use the buttons below 👇")
+
+# ========= USER CALLBACKS =========
+@callback_route("user", "bonus")
+async def cb_bonus(update: Update, context: BotContext):
+    q = update.callback_query
+    rec = await load_user(context, q.from_user.id)
+    amt = SETTINGS.daily_bonus_amount
+    last = rec.last_bonus_ts
+    now = int(time.time())
+    if last and now - last < BONUS_PERIOD:
+        wait_h = (last + BONUS_PERIOD - now) // 3600 + 1
+        await q.answer("Come back later for your next daily bonus.", show_alert=True)
+    else:
+        rec.credit(amt, REASON_DAILY_BONUS)
+        rec.set("last_bonus_ts", now)
+        await save_user(rec)
+        await q.answer(f"🎁 Daily bonus added: {fmt_amount(amt)}", show_alert=True)
+    await send_user_home(update, context)
+
+@callback_route("user", "reflink")
+async def cb_reflink(update: Update, context: BotContext):
+    q = update.callback_query
+    # username was fetched once by Application.initialize(); no API call here
+    link = f"https://t.me/{context.bot.username}?start={q.from_user.id}"
+    txt = ("👥 *Your Referral Link*\n"
+           f"{link}\n\n"
+           f"Reward per referral: *{fmt_amount(SETTINGS.referral_bonus_amount)}*")
+    await q.edit_message_text(txt, parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_kb())
+
+@callback_route("user", "channels")
+async def cb_channels(update: Update, context: BotContext):
+    await update.callback_query.edit_message_text(channels_text(), parse_mode=ParseMode.MARKDOWN,
+                                                  reply_markup=channels_kb())
+
+@callback_route("user", "joinedcheck")
+async def cb_joinedcheck(update: Update, context: BotContext):
     q = update.callback_query
     uid = q.from_user.id
-    if not is_admin(uid):
-        await q.answer("Not admin.", show_alert=True)
+    ok = await check_user_joined_all(context, uid)
+    if not ok:
+        await q.answer("❌ You haven't joined all channels yet.", show_alert=True)
         return
+    rec = await load_user(context, uid)
+    if not rec.passed_join_check:
+        rec.set("passed_join_check", True)
+        # handle referral credit once
+        if not rec.ref_credit_given:
+            if rec.ref_by:
+                bonus = SETTINGS.referral_bonus_amount
+                rec.credit(bonus, REASON_REFERRAL, user_id=rec.ref_by)
+            rec.set("ref_credit_given", True)
+        await save_user(rec)
+    await q.answer("✅ All set. Thanks!", show_alert=True)
+    await send_user_home(update, context, "✅ Join-check passed. You're good!")
+
+@callback_route("user", "withdraw")
+async def cb_withdraw(update: Update, context: BotContext):
+    q = update.callback_query
+    if not SETTINGS.withdraw_open:
+        await q.answer("Withdrawals are currently OFF.", show_alert=True)
+        return
+    rec = await load_user(context, q.from_user.id)
+    curbal = rec.balance
+    mn = SETTINGS.min_withdraw
+    mx = SETTINGS.max_withdraw
+    txt = (f"💸 *Request Withdrawal*\n"
+           f"Balance: *{fmt_amount(curbal)}*\n"
+           f"Min: *{fmt_amount(mn)}*  |  Max: *{fmt_amount(mx)}*\n\n"
+           "Send your request in this format:\n"
+           "`amount wallet_or_account`\n"
+           "Example:\n"
+           "`2000 0123456789-AccessBank`\n"
+           "Or your crypto tag.\n\n"
+           "_Type /cancel to abort._")
+    context.user_data["await"] = ("withdraw_req",)
+    await q.edit_message_text(txt, parse_mode=ParseMode.MARKDOWN)
+
+@callback_route("user", "myrefs")
+async def cb_myrefs(update: Update, context: BotContext):
+    q = update.callback_query
+    uid = q.from_user.id
+    referred, verified, earned = await referral_stats(uid)
+    recent = await recent_referrals(uid)
+    lines = ["📊 *My Referrals*",
+             f"Invited: *{referred}*  |  Verified: *{verified}*",
+             f"Earned: *{fmt_amount(earned)}*"]
+    if recent:
+        lines.append("\nLatest:")
+        lines += [f"• `{rid}` {'✅' if passed else '⏳'}" for rid, passed in recent]
+    await q.edit_message_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_kb())
+
+@callback_route("user", "help")
+async def cb_help(update: Update, context: BotContext):
+    txt = ("*Help*\n"
+           "• Use the buttons to get bonus, referral link, channels and withdraw.\n"
+           "• Ask admin for support if needed.")
+    await update.callback_query.edit_message_text(txt, parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_kb())
+
+@callback_route("user", "remind")
+async def cb_remind(update: Update, context: BotContext):
+    q = update.callback_query
+    rec = await load_user(context, q.from_user.id)
+    rec.set("bonus_remind", not rec.bonus_remind)
+    await save_user(rec)
+    if rec.bonus_remind:
+        await q.answer("🔔 Reminders on: we'll message you when your daily bonus is ready.", show_alert=True)
+        # the job only looks ahead, so a bonus that is already claimable is reminded here
+        if not rec.last_bonus_ts or time.time() - rec.last_bonus_ts >= BONUS_PERIOD:
+            await context.bot.send_message(chat_id=rec.id, text=REMIND_TEXT, reply_markup=REMIND_KB)
+    else:
+        await q.answer("🔕 Bonus reminders off.", show_alert=True)
 
-    data = q.data
-    if data == "admin:close":
-        await q.edit_message_text("Closed.")
+@text_route("withdraw_req")
+async def mode_withdraw_req(update: Update, context: BotContext, text: str):
+    uid = update.effective_user.id
+    rec = await load_user(context, uid)
+    parts = text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("Format: `amount wallet_or_account`\nExample: `2000 0123456789-AccessBank`", parse_mode=ParseMode.MARKDOWN)
+        return
+    try:
+        amount = parse_amount(parts[0])
+    except ValueError:
+        await update.message.reply_text("Send a number only.")
         return
+    wallet = parts[1]
+    mn = SETTINGS.min_withdraw
+    mx = SETTINGS.max_withdraw
+    bal = rec.balance
+    if amount < mn or amount > mx:
+        await update.message.reply_text(f"Amount must be between {fmt_amount(mn)} and {fmt_amount(mx)}.")
+        return
+    if amount > bal:
+        await update.message.reply_text("Insufficient balance.")
+        return
+    # create request (status=pending); do NOT deduct yet (safer)
+    await db_exec("INSERT INTO withdraw_requests(user_id, amount, wallet, status, created_at) VALUES(?,?,?,?,?)",
+            (uid, to_minor(amount), wallet, "pending", int(time.time())))
+    # notify admin (batched into the next digest)
+    WD_DIGEST.add(context.bot, uid, amount, wallet)
+    await update.message.reply_text("✅ Withdrawal request submitted. Admin will review.")
+    context.user_data.pop("await", None)
 
-    if data == "admin:add_balance":
-        context.user_data["await"] = ("add_balance",)
-        await q.edit_message_text("Send: `user_id amount`\nExample: `123456789 500`", parse_mode=ParseMode.MARKDOWN)
+# ========= ADMIN PANEL CALLBACKS =========
+# Buttons that only ask for input: the awaited mode has the action's name.
+ADMIN_PROMPTS = {
+    "add_balance": "Send: `user_id amount`\nExample: `123456789 500`",
+    "remove_balance": "Send: `user_id amount`\nExample: `123456789 200`",
+    "set_currency": "Send currency code or symbol (e.g. `NGN`, `USD`, `₦`):",
+    "set_min": "Send *minimum withdraw* amount (number):",
+    "set_max": "Send *maximum withdraw* amount (number):",
+    "set_channels": ("Send channel usernames separated by space (e.g. `@chan1 @chan2`).\n"
+                     "➡️ Make sure the *bot is an admin* in each channel."),
+    "ban": "Send: `user_id` to BAN:",
+    "unban": "Send: `user_id` to UNBAN:",
+    "bulk_import": ("Upload a *CSV/TSV file* with one row per change:\n"
+                    "`user_id,amount` (signed)\n"
+                    "`user_id,add,amount` / `user_id,remove,amount`\n"
+                    "`user_id,ban` / `user_id,unban`\n\n"
+                    "Invalid rows are skipped and sent back in an error file."),
+    "broadcast": "Send the *message* to broadcast to all users.\n(_Markdown supported_)",
+    "wd_history": "Send: `user_id` to list their withdrawals:",
+}
 
-    elif data == "admin:remove_balance":
-        context.user_data["await"] = ("remove_balance",)
-        await q.edit_message_text("Send: `user_id amount`\nExample: `123456789 200`", parse_mode=ParseMode.MARKDOWN)
+async def cb_admin_prompt(update: Update, context: BotContext, mode: str):
+    context.user_data["await"] = (mode,)
+    await update.callback_query.edit_message_text(ADMIN_PROMPTS[mode], parse_mode=ParseMode.MARKDOWN)
 
-    elif data == "admin:set_currency":
-        context.user_data["await"] = ("set_currency",)
-        await q.edit_message_text("Send currency code or symbol (e.g. `NGN`, `USD`, `₦`):", parse_mode=ParseMode.MARKDOWN)
+for _mode in ADMIN_PROMPTS:
+    callback_route("admin", _mode, mode=_mode)(cb_admin_prompt)
 
-    elif data == "admin:set_min":
-        context.user_data["await"] = ("set_min",)
-        await q.edit_message_text("Send *minimum withdraw* amount (number):", parse_mode=ParseMode.MARKDOWN)
+@callback_route("admin", "close")
+async def cb_admin_close(update: Update, context: BotContext):
+    await update.callback_query.edit_message_text("Closed.")
 
-    elif data == "admin:set_max":
-        context.user_data["await"] = ("set_max",)
-        await q.edit_message_text("Send *maximum withdraw* amount (number):", parse_mode=ParseMode.MARKDOWN)
+@callback_route("admin", "panel")
+async def cb_admin_panel(update: Update, context: BotContext):
+    await update.callback_query.edit_message_text("🛠 *Admin Panel*", reply_markup=admin_panel_kb(),
+                                                  parse_mode=ParseMode.MARKDOWN)
 
-    elif data == "admin:set_channels":
-        context.user_data["await"] = ("set_channels",)
-        await q.edit_message_text(
-            "Send channel usernames separated by space (e.g. `@chan1 @chan2`).\n"
-            "➡️ Make sure the *bot is an admin* in each channel.",
-            parse_mode=ParseMode.MARKDOWN
-        )
+@callback_route("admin", "view_channels")
+async def cb_view_channels(update: Update, context: BotContext):
+    chs = parse_channels()
+    txt = "Current channels:\n" + ("\n".join([f"• {c}" for c in chs]) if chs else "— none —")
+    await update.callback_query.edit_message_text(txt, reply_markup=admin_panel_kb())
 
-    elif data == "admin:view_channels":
-        chs = parse_channels()
-        txt = "Current channels:\n" + ("\n".join([f"• {c}" for c in chs]) if chs else "— none —")
-        await q.edit_message_text(txt, reply_markup=admin_panel_kb())
+@callback_route("admin", "bc_cancel", int)
+async def cb_bc_cancel(update: Update, context: BotContext, bc_id: int):
+    q = update.callback_query
+    if await cancel_broadcast(bc_id):
+        await q.answer("Cancelling broadcast…")
+    else:
+        await q.answer("Broadcast already finished.", show_alert=True)
 
-    elif data == "admin:ban":
-        context.user_data["await"] = ("ban",)
-        await q.edit_message_text("Send: `user_id` to BAN:", parse_mode=ParseMode.MARKDOWN)
+@callback_route("admin", "wdq", int)
+async def cb_wd_queue(update: Update, context: BotContext, after_id: int):
+    text, kb = await withdraw_queue_view(after_id)
+    await update.callback_query.edit_message_text(text, reply_markup=kb)
 
-    elif data == "admin:unban":
-        context.user_data["await"] = ("unban",)
-        await q.edit_message_text("Send: `user_id` to UNBAN:", parse_mode=ParseMode.MARKDOWN)
+@callback_route("admin", "wdq_ok", int, int, approve=True)
+@callback_route("admin", "wdq_no", int, int, approve=False)
+async def cb_wd_review_page(update: Update, context: BotContext, after_id: int, last_id: int, approve: bool):
+    q = update.callback_query
+    done, skipped = await review_page(approve, after_id, last_id)
+    note = f"{'Approved' if approve else 'Rejected'} {done}"
+    if skipped:
+        note += f", skipped {skipped} (insufficient balance)"
+    await q.answer(note, show_alert=bool(skipped))
+    text, kb = await withdraw_queue_view(after_id)
+    await q.edit_message_text(text, reply_markup=kb)
+
+@callback_route("admin", "wd_ok", int, int, approve=True)
+@callback_route("admin", "wd_no", int, int, approve=False)
+async def cb_wd_review_one(update: Update, context: BotContext, wd_id: int, after_id: int, approve: bool):
+    q = update.callback_query
+    done, skipped = await review_one(approve, wd_id)
+    if skipped:
+        await q.answer(f"#{wd_id}: insufficient balance.", show_alert=True)
+    elif done:
+        await q.answer(f"#{wd_id} {'approved' if approve else 'rejected'}.")
+    else:
+        await q.answer(f"#{wd_id} was already handled.")
+    text, kb = await withdraw_queue_view(after_id)
+    await q.edit_message_text(text, reply_markup=kb)
+
+@callback_route("admin", "ref_top")
+async def cb_ref_top(update: Update, context: BotContext):
+    rows = await leaderboard()
+    lines = [f"🏆 Top referrers (refreshed every {int(LEADERBOARD_REFRESH // 60)} min)"]
+    for i, (ref_uid, verified, referred, earned) in enumerate(rows, 1):
+        lines.append(f"{i}. {ref_uid} — {verified} verified / {referred} invited • {fmt_amount(earned)}")
+    if not rows:
+        lines.append("No referrals yet.")
+    await update.callback_query.edit_message_text("\n".join(lines), reply_markup=admin_panel_kb())
+
+@callback_route("admin", "toggle_wd")
+async def cb_toggle_wd(update: Update, context: BotContext):
+    newv = "0" if SETTINGS.withdraw_open else "1"
+    await set_setting("withdraw_open", newv)
+    await update.callback_query.edit_message_text(f"Withdraw toggled to: {'ON' if newv=='1' else 'OFF'}",
+                                                  reply_markup=admin_panel_kb())
+
+# ========= ADMIN TEXT INPUT =========
+@text_route("add_balance", admin=True, remove=False)
+@text_route("remove_balance", admin=True, remove=True)
+async def mode_change_balance(update: Update, context: BotContext, text: str, remove: bool):
+    parts = text.split()
+    if len(parts) != 2:
+        await update.message.reply_text("Send exactly: `user_id amount`", parse_mode=ParseMode.MARKDOWN)
+        return
+    try:
+        tgt = int(parts[0])
+    except ValueError:
+        await update.message.reply_text("Numbers only. Example: `123456789 500`", parse_mode=ParseMode.MARKDOWN)
+        return
+    try:
+        amt = parse_amount(parts[1])
+    except ValueError:
+        await update.message.reply_text("Send a number only.")
+        return
+    await add_user_if_not_exists(tgt)
+    if remove:
+        bal = await change_balance(tgt, -amt, REASON_ADMIN_REMOVE)
+    else:
+        bal = await change_balance(tgt, amt, REASON_ADMIN_ADD)
+    await update.message.reply_text(f"✅ Done. New balance for {tgt}: {fmt_amount(bal or 0.0)}")
+    context.user_data.pop("await", None)
+
+@text_route("set_currency", admin=True)
+async def mode_set_currency(update: Update, context: BotContext, text: str):
+    await set_setting("currency", text)
+    await update.message.reply_text(f"✅ Currency set to: {text}")
+    context.user_data.pop("await", None)
+
+@text_route("set_min", admin=True)
+async def mode_set_min(update: Update, context: BotContext, text: str):
+    try:
+        val = parse_amount(text)
+    except ValueError:
+        await update.message.reply_text("Send a number only.")
+        return
+    await set_setting("min_withdraw", str(val))
+    await update.message.reply_text(f"✅ Min withdraw set to {fmt_amount(val)}")
+    context.user_data.pop("await", None)
 
-    elif data == "admin:broadcast":
-        context.user_data["await"] = ("broadcast",)
-        await q.edit_message_text("Send the *message* to broadcast to all users.\n(_Markdown supported_)", parse_mode=ParseMode.MARKDOWN)
+@text_route("set_max", admin=True)
+async def mode_set_max(update: Update, context: BotContext, text: str):
+    try:
+        val = parse_amount(text)
+    except ValueError:
+        await update.message.reply_text("Send a number only.")
+        return
+    await set_setting("max_withdraw", str(val))
+    await update.message.reply_text(f"✅ Max withdraw set to {fmt_amount(val)}")
+    context.user_data.pop("await", None)
+
+@text_route("set_channels", admin=True)
+async def mode_set_channels(update: Update, context: BotContext, text: str):
+    chans = [c for c in text.split() if c.startswith("@")]
+    await set_setting("channels", json.dumps(chans))
+    await update.message.reply_text(f"✅ Channels set: {' '.join(chans) if chans else '— none —'}\n"
+                                    "Remember: add the *bot as ADMIN* in each channel.",
+                                    parse_mode=ParseMode.MARKDOWN)
+    context.user_data.pop("await", None)
+
+@text_route("ban", admin=True, banned=True)
+@text_route("unban", admin=True, banned=False)
+async def mode_ban(update: Update, context: BotContext, text: str, banned: bool):
+    try:
+        tgt = int(text)
+        await add_user_if_not_exists(tgt)
+        await set_ban(tgt, banned)
+        await update.message.reply_text(f"🚫 User {tgt} banned." if banned else f"✅ User {tgt} unbanned.")
+        context.user_data.pop("await", None)
+    except Exception:
+        await update.message.reply_text("Send a valid user_id (number).")
 
-    elif data == "admin:toggle_wd":
-        cur = get_setting("withdraw_open") or "1"
-        newv = "0" if cur == "1" else "1"
-        set_setting("withdraw_open", newv)
-        await q.edit_message_text(f"Withdraw toggled to: {'ON' if newv=='1' else 'OFF'}", reply_markup=admin_panel_kb())
+@text_route("wd_history", admin=True)
+async def mode_wd_history(update: Update, context: BotContext, text: str):
+    try:
+        tgt = int(text)
+    except ValueError:
+        await update.message.reply_text("Send a valid user_id (number).")
+        return
+    await update.message.reply_text(await withdraw_history_text(tgt))
+    context.user_data.pop("await", None)
+
+@text_route("broadcast", admin=True)
+async def mode_broadcast(update: Update, context: BotContext, text: str):
+    cur = await db_exec(
+        "INSERT INTO broadcasts(text, status, last_user_id, sent, failed, blocked, chat_id, created_at) "
+        "VALUES(?,?,?,?,?,?,?,?)",
+        (text, "running", 0, 0, 0, 0, update.effective_chat.id, int(time.time())))
+    bc_id = cur.lastrowid
+    progress = await update.message.reply_text(broadcast_text(bc_id, "starting…", 0, 0, 0),
+                                               reply_markup=broadcast_kb(bc_id))
+    await db_exec("UPDATE broadcasts SET message_id=? WHERE id=?", (progress.message_id, bc_id))
+    start_broadcast(context.application, bc_id)
+    context.user_data.pop("await", None)
+
+# ========= FLOOD CONTROL =========
+# First handler group: a per-user token bucket and the in-memory ban list are
+# checked before any handler touches the database. Over-limit updates are
+# dropped (a callback gets one cheap "slow down" answer per flood episode).
+# Bucket state lives in a bounded LRU, so memory stays flat with any number
+# of users; an evicted user simply starts again with a full bucket.
+FLOOD_RATE = 1.0          # tokens refilled per second
+FLOOD_BURST = 10.0        # bucket size
+FLOOD_TRACKED_USERS = 100_000
+
+# ids of banned users; loaded in init_db and kept in sync by every ban write
+BANNED = _PerBot("banned")
+
+class FloodGate:
+    def __init__(self, rate: float, burst: float, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # user id -> [tokens, stamp, warned]
+
+    def allow(self, user_id: int) -> Tuple[bool, bool]:
+        """Return (allowed, should_warn)."""
+        now = time.monotonic()
+        b = self._buckets.get(user_id)
+        if b is None:
+            b = self._buckets[user_id] = [self.burst, now, False]
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        if not take_token(b, self.rate, self.burst, now):
+            b[2] = False
+            return True, False
+        warn = not b[2]
+        b[2] = True
+        return False, warn
 
-# ========= ADMIN/USER TEXT INPUT HANDLER =========
-async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Handle awaited inputs for admin or user withdrawal
-    awaitable = context.user_data.get("await")
-    text = (update.message.text or "").strip()
+FLOOD = _PerBot("flood")
 
-    # User withdrawal request
-    if awaitable and awaitable[0] == "withdraw_req":
-        uid = update.effective_user.id
-        if is_banned(uid):
+async def flood_gate(update: Update, context: BotContext):
+    user = update.effective_user
+    if user is None or is_admin(user.id):
+        return
+    allowed, warn = FLOOD.allow(user.id)
+    if not allowed:
+        METRICS.inc("bot_updates_dropped_total", (("reason", "flood"),))
+        if warn and update.callback_query:
+            await update.callback_query.answer("⏳ Slow down a little.")
+        raise ApplicationHandlerStop
+    # the one ban check: it runs in group -1, before every handler
+    if user.id in BANNED:
+        METRICS.inc("bot_updates_dropped_total", (("reason", "banned"),))
+        if update.callback_query:
+            await update.callback_query.answer("You are banned.", show_alert=True)
+        elif update.message:
             await update.message.reply_text("You are banned.")
-            context.user_data.pop("await", None)
-            return
-        parts = text.split(maxsplit=1)
-        if len(parts) < 2:
-            await update.message.reply_text("Format: `amount wallet_or_account`\nExample: `2000 0123456789-AccessBank`", parse_mode=ParseMode.MARKDOWN)
+        raise ApplicationHandlerStop
+
+# ========= CONVERSATION STATE =========
+# context.user_data["await"] (the current step of a multi-step flow) survives
+# restarts. Only that key is stored, one row per user. Writes are write-behind:
+# PTB hands us changed user_data every CONV_STATE_FLUSH seconds and at stop;
+# unchanged states are skipped and the rest go to the DB as one batch. States
+# are read lazily, once per user, inside per_user (after flood control and in
+# arrival order), so startup doesn't scale with the user base.
+CONV_STATE_FLUSH = 5.0
+
+def _save_states(conn: sqlite3.Connection, upserts: list, deletes: list):
+    if upserts:
+        conn.executemany(
+            "INSERT INTO conversation_state(user_id, state, updated_at) VALUES(?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+            upserts)
+    if deletes:
+        conn.executemany("DELETE FROM conversation_state WHERE user_id=?", deletes)
+
+class StatePersistence(BasePersistence):
+    def __init__(self, update_interval: float = CONV_STATE_FLUSH):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                                     user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self._saved = {}     # user id -> state as last read/written
+        self._pending = {}   # user id -> state waiting for the next batch
+        self._flushing: Optional[asyncio.Task] = None
+
+    async def load(self, user_id: int, user_data: dict):
+        if user_id in self._saved:
             return
+        row = await db_fetchone("SELECT state FROM conversation_state WHERE user_id=?", (user_id,))
+        state = tuple(json.loads(row[0])) if row else None
+        self._saved[user_id] = state
+        if state is not None and "await" not in user_data:
+            user_data["await"] = state
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        state = data.get("await")
+        if user_id not in self._saved or self._saved[user_id] == state:
+            return  # never loaded (handler without per_user) or unchanged
+        self._saved[user_id] = state
+        self._pending[user_id] = state
+        if self._flushing is None:
+            # PTB gathers one call per user; start writing once they've all queued
+            self._flushing = asyncio.create_task(self._write())
+
+    async def _write(self):
+        await asyncio.sleep(0)
         try:
-            amount = float(parts[0])
-        except Exception:
-            await update.message.reply_text("Amount must be a number.")
-            return
-        wallet = parts[1]
-        mn = float(get_setting("min_withdraw") or "1000")
-        mx = float(get_setting("max_withdraw") or "500000")
-        bal = get_balance(uid)
-        if amount < mn or amount > mx:
-            await update.message.reply_text(f"Amount must be between {fmt_amount(mn)} and {fmt_amount(mx)}.")
-            return
-        if amount > bal:
-            await update.message.reply_text("Insufficient balance.")
-            return
-        # create request (status=pending); do NOT deduct yet (safer)
-        db_exec("INSERT INTO withdraw_requests(user_id, amount, wallet, status, created_at) VALUES(?,?,?,?,?)",
-                (uid, amount, wallet, "pending", datetime.utcnow().isoformat()))
-        # notify admin
-        if admin_id():
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id(),
-                    text=(f"🆕 *Withdraw Request*\nUser: `{uid}`\nAmount: *{fmt_amount(amount)}*\nWallet: `{wallet}`"),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            except Exception:
-                pass
-        await update.message.reply_text("✅ Withdrawal request submitted. Admin will review.")
-        context.user_data.pop("await", None)
-        return
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                now = int(time.time())
+                upserts = [(uid, json.dumps(s), now) for uid, s in pending.items() if s is not None]
+                deletes = [(uid,) for uid, s in pending.items() if s is None]
+                await db_write(_save_states, upserts, deletes)
+        finally:
+            self._flushing = None
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._saved[user_id] = None
+        self._pending[user_id] = None
+        if self._flushing is None:
+            self._flushing = asyncio.create_task(self._write())
+
+    async def flush(self) -> None:
+        if self._flushing is not None:
+            await self._flushing
+        if self._pending:
+            await self._write()
+
+    async def get_user_data(self) -> dict:
+        return {}  # loaded lazily per user, see load()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
 
-    # Admin awaited operations
-    if awaitable and is_admin(update.effective_user.id):
-        mode = awaitable[0]
+    # only user_data is persisted
+    async def get_chat_data(self) -> dict:
+        return {}
 
-        if mode in ("add_balance", "remove_balance"):
-            parts = text.split()
-            if len(parts) != 2:
-                await update.message.reply_text("Send exactly: `user_id amount`", parse_mode=ParseMode.MARKDOWN)
-                return
-            try:
-                tgt = int(parts[0]); amt = float(parts[1])
-            except Exception:
-                await update.message.reply_text("Numbers only. Example: `123456789 500`", parse_mode=ParseMode.MARKDOWN)
-                return
-            add_user_if_not_exists(tgt)
-            change = amt if mode == "add_balance" else -amt
-            change_balance(tgt, change)
-            await update.message.reply_text(f"✅ Done. New balance for {tgt}: {fmt_amount(get_balance(tgt))}")
-            context.user_data.pop("await", None)
-            return
+    async def get_bot_data(self) -> dict:
+        return {}
 
-        if mode == "set_currency":
-            set_setting("currency", text)
-            await update.message.reply_text(f"✅ Currency set to: {text}")
-            context.user_data.pop("await", None)
-            return
+    async def get_callback_data(self):
+        return None
 
-        if mode == "set_min":
-            try:
-                val = float(text)
-                set_setting("min_withdraw", str(val))
-                await update.message.reply_text(f"✅ Min withdraw set to {fmt_amount(val)}")
-                context.user_data.pop("await", None)
-            except Exception:
-                await update.message.reply_text("Send a number only.")
-            return
+    async def get_conversations(self, name: str) -> dict:
+        return {}
 
-        if mode == "set_max":
-            try:
-                val = float(text)
-                set_setting("max_withdraw", str(val))
-                await update.message.reply_text(f"✅ Max withdraw set to {fmt_amount(val)}")
-                context.user_data.pop("await", None)
-            except Exception:
-                await update.message.reply_text("Send a number only.")
-            return
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
 
-        if mode == "set_channels":
-            chans = [c for c in text.split() if c.startswith("@")]
-            set_setting("channels", json.dumps(chans))
-            await update.message.reply_text(f"✅ Channels set: {' '.join(chans) if chans else '— none —'}\n"
-                                            "Remember: add the *bot as ADMIN* in each channel.",
-                                            parse_mode=ParseMode.MARKDOWN)
-            context.user_data.pop("await", None)
-            return
+    async def update_bot_data(self, data: dict) -> None:
+        pass
 
-        if mode == "ban":
-            try:
-                tgt = int(text)
-                add_user_if_not_exists(tgt)
-                set_ban(tgt, True)
-                await update.message.reply_text(f"🚫 User {tgt} banned.")
-                context.user_data.pop("await", None)
-            except Exception:
-                await update.message.reply_text("Send a valid user_id (number).")
-            return
+    async def update_callback_data(self, data) -> None:
+        pass
 
-        if mode == "unban":
-            try:
-                tgt = int(text)
-                add_user_if_not_exists(tgt)
-                set_ban(tgt, False)
-                await update.message.reply_text(f"✅ User {tgt} unbanned.")
-                context.user_data.pop("await", None)
-            except Exception:
-                await update.message.reply_text("Send a valid user_id (number).")
-            return
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
 
-        if mode == "broadcast":
-            msg = text
-            ids = all_user_ids()
-            sent, fail = 0, 0
-            for uid in ids:
-                try:
-                    await context.bot.send_message(chat_id=uid, text=msg, parse_mode=ParseMode.MARKDOWN)
-                    sent += 1
-                except Exception:
-                    fail += 1
-            await update.message.reply_text(f"📢 Broadcast done. Sent: {sent}, Failed: {fail}")
-            context.user_data.pop("await", None)
-            return
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
 
-    # If no awaited action: basic echo/help for normal users (ignore commands handled elsewhere)
-    if not is_admin(update.effective_user.id):
-        if is_banned(update.effective_user.id):
-            await update.message.reply_text("You are banned.")
-            return
-        await send_user_home(update, context, "Hello! Use the buttons below 👇")
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+CONV_STATE = _PerBot("conv_state")
+
+# ========= UPDATE ORDERING =========
+# Updates are processed concurrently, but one user's updates must still run in
+# arrival order so the context.user_data["await"] steps can't race. Handlers
+# are wrapped in a per-user FIFO lock; idle locks are dropped right away.
+_USER_LOCKS = _PerBot("user_locks")  # user id -> [lock, holders+waiters]
+
+def per_user(callback: Callable) -> Callable:
+    @wraps(callback)
+    async def wrapper(update: Update, context: BotContext):
+        user = update.effective_user
+        if user is None:
+            return await callback(update, context)
+        entry = _USER_LOCKS.get(user.id)
+        if entry is None:
+            entry = _USER_LOCKS[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await CONV_STATE.load(user.id, context.user_data)
+                return await callback(update, context)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _USER_LOCKS[user.id]
+    return wrapper
+
+# ========= HOSTED BOTS =========
+class BotState:
+    """Everything one bot keeps in memory; the _PerBot names resolve to these attributes."""
+
+    def __init__(self, name: str, db_path: str, archive_path: Optional[str] = None,
+                 readers: int = DB_READERS, executor: Optional[ThreadPoolExecutor] = None,
+                 labels: tuple = ()):
+        self.name = name
+        self.labels = labels  # added to every metric series, e.g. (("bot", name),)
+        self.metrics = Metrics(METRICS_ENABLED)
+        self.db = Database(db_path, readers, archive_path, executor)
+        self.writer = GroupCommitter(self.db)
+        self.settings = Settings()
+        self.banned = set()
+        self.flood = FloodGate(FLOOD_RATE, FLOOD_BURST, FLOOD_TRACKED_USERS)
+        self.join_cache = TTLCache(JOIN_CACHE_SIZE)
+        self.bulk_bucket = TokenBucket(BROADCAST_RATE)
+        self.broadcasts = {}
+        self.leaderboard = {"at": 0.0, "rows": []}
+        self.reminders = set()
+        self.remind_cursor = [None]
+        self.digest = WithdrawDigest()
+        self.maint = {"at": 0.0, "checkpoint": None, "archived": 0, "freed": 0, "running": False}
+        self.conv_state = StatePersistence()
+        self.user_locks = {}
+
+DEFAULT_BOT = BotState("default", DB_PATH, ARCHIVE_DB or None)
+_CURRENT: "contextvars.ContextVar[BotState]" = contextvars.ContextVar("bot", default=DEFAULT_BOT)
+_HOSTED = []  # bots between startup and shutdown, rendered on the metrics port
+
+def current_bot() -> BotState:
+    return _CURRENT.get()
 
 # ========= SETUP & RUN =========
 async def on_startup(app):
     # Ensure DB initialized
     init_db()
-    me = await app.bot.get_me()
-    print(f"Bot @{me.username} is online.")
+    _HOSTED.append(current_bot())
+    print(f"Bot @{app.bot.username} is online.")
+    await resume_broadcasts(app)
+    await start_metrics_server()
+
+async def on_stop(app):
+    # the bot can still send here; post_shutdown runs after it is closed
+    await WD_DIGEST.close()
+
+async def on_shutdown(app):
+    if current_bot() in _HOSTED:
+        _HOSTED.remove(current_bot())
+    if not _HOSTED:
+        await stop_metrics_server()
+    await stop_broadcasts()
+    await stop_reminders()
+    await WRITER.close()
+    DB.close()
+
+def build_application(token: str = TOKEN, request: Optional[BaseRequest] = None,
+                      updates_request: Optional[BaseRequest] = None,
+                      shared_gate: Optional[PriorityGate] = None) -> Application:
+    """Application for the current bot (see HOSTED BOTS)."""
+    builder = (
+        ApplicationBuilder().token(token)
+        .context_types(ContextTypes(context=BotContext))
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .persistence(current_bot().conv_state)
+        .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        # custom transport, e.g. the fake Bot API in bench.py or the runner's shared pools
+        updates_request = updates_request or request
+    else:
+        # same pool sizes ApplicationBuilder would pick by default
+        request, updates_request = HTTPXRequest(connection_pool_size=256), HTTPXRequest(connection_pool_size=1)
+    builder = builder.request(MeteredRequest(request)).get_updates_request(MeteredRequest(updates_request))
+    builder = builder.rate_limiter(OutboundScheduler(OUT_RATE, OUT_CHAT_RATE, OUT_CHAT_BURST, OUT_GROUP_RATE,
+                                                     shared=shared_gate))
+    application = builder.build()
+
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(remind_bonus_job, interval=REMIND_INTERVAL, first=5)
+        application.job_queue.run_repeating(maintenance_job, interval=MAINT_INTERVAL, first=MAINT_INTERVAL)
+        application.job_queue.run_repeating(dashboard_job, interval=DASH_INTERVAL, first=10)
+
+    application.add_handler(TypeHandler(Update, flood_gate), group=-1)
+    application.add_handler(CommandHandler("start", per_user(timed(cmd_start))))
+    application.add_handler(CommandHandler("admin", per_user(timed(cmd_admin))))
+    application.add_handler(CommandHandler("claimadmin", per_user(timed(cmd_claimadmin))))
+    application.add_handler(CommandHandler("stats", timed(cmd_stats)))
+    application.add_handler(CommandHandler("export", per_user(timed(cmd_export))))
+    application.add_handler(CommandHandler("myid", timed(cmd_myid)))
+    application.add_handler(CommandHandler("cancel", per_user(timed(cmd_cancel))))
+    application.add_handler(CommandHandler("db", per_user(timed(cmd_db))))
+    application.add_handler(CommandHandler("dashboard", per_user(timed(cmd_dashboard))))
+
+    application.add_handler(CallbackQueryHandler(per_user(timed(on_callback))))
 
-def main():
-    init_db()
-    application = ApplicationBuilder().token(TOKEN).post_init(on_startup).build()
+    # Text input handler for awaited steps & simple fallback
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user(timed(on_text))))
+    application.add_handler(MessageHandler(filters.Document.ALL, per_user(timed(on_document))))
+    return application
+
+# ========= MULTI-BOT RUNNER =========
+# Hosts every bot listed in a JSON file on one event loop:
+#   [{"name": "shop", "token": "123:ABC", "db": "shop.db"}, ...]   ("archive_db" optional)
+# Each bot gets its own Application, database, settings cache and metrics
+# (labelled bot="<name>" on the shared metrics port). The HTTP connection
+# pools, the DB thread pool (at most RUNNER_DB_READERS + 1 jobs per bot in it,
+# so one bot's VACUUM or import can't take every thread) and an outbound budget
+# of RUNNER_API_RATE calls/s (on top of each bot's own limits) are shared. Bots use long polling; a bot
+# that fails to start is reported and the others keep running.
+RUNNER_API_RATE = 100.0
+RUNNER_DB_THREADS = 8
+RUNNER_DB_READERS = 2      # read connections per bot
+RUNNER_HTTP_POOL = 256
+
+def load_bots(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path}: expected a non-empty JSON list of bots")
+    names, dbs = set(), set()
+    for i, e in enumerate(entries):
+        if not isinstance(e, dict) or not all(isinstance(e.get(k), str) and e[k] for k in ("name", "token", "db")):
+            raise ValueError(f"{path}: entry {i} needs string \"name\", \"token\" and \"db\"")
+        db = os.path.abspath(e["db"])
+        if e["name"] in names or db in dbs:
+            raise ValueError(f"{path}: duplicate name or db in entry {i}")
+        names.add(e["name"])
+        dbs.add(db)
+    return entries
+
+class SharedRequest(BaseRequest):
+    """Lets several bots use one HTTP pool; run_bots owns it, so per-bot initialize/shutdown do nothing."""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    async def initialize(self) -> None:
+        pass
 
-    application.add_handler(CommandHandler("start", cmd_start))
-    application.add_handler(CommandHandler("admin", cmd_admin))
-    application.add_handler(CommandHandler("claimadmin", cmd_claimadmin))
-    application.add_handler(CommandHandler("myid", cmd_myid))
+    async def shutdown(self) -> None:
+        pass
 
-    application.add_handler(CallbackQueryHandler(on_admin_callback, pattern=r"^admin:"))
-    application.add_handler(CallbackQueryHandler(on_user_callback, pattern=r"^user:"))
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE) -> Tuple[int, bytes]:
+        return await self.inner.do_request(
+            url, method, request_data=request_data, read_timeout=read_timeout,
+            write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+
+async def _teardown(app: Application):
+    # same order as run_polling, skipping the steps that never happened
+    if app.updater is not None and app.updater.running:
+        await app.updater.stop()
+    if app.running:
+        await app.stop()
+        await on_stop(app)
+    await app.shutdown()
+    await on_shutdown(app)
+
+async def _host(state: BotState, token: str, request: BaseRequest, updates_request: BaseRequest,
+                gate: PriorityGate, stop: asyncio.Event):
+    _CURRENT.set(state)  # this task and everything it starts belong to `state`
+    app = build_application(token, request=request, updates_request=updates_request, shared_gate=gate)
+    try:
+        await app.initialize()
+        await on_startup(app)
+        await app.updater.start_polling()
+        await app.start()
+    except Exception as e:
+        print(f"[{state.name}] failed to start: {e!r}")
+        await _teardown(app)
+        return
+    try:
+        await stop.wait()
+    finally:
+        await _teardown(app)
+
+async def run_bots(path: str):
+    entries = load_bots(path)
+    executor = ThreadPoolExecutor(max_workers=RUNNER_DB_THREADS, thread_name_prefix="db")
+    http = HTTPXRequest(connection_pool_size=RUNNER_HTTP_POOL)
+    polling = HTTPXRequest(connection_pool_size=len(entries))  # one long poll per bot
+    gate = PriorityGate(RUNNER_API_RATE)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):  # no signal support here; Ctrl+C still exits
+            pass
+    bots = [BotState(e["name"], e["db"], e.get("archive_db") or None, RUNNER_DB_READERS, executor,
+                     labels=(("bot", e["name"]),)) for e in entries]
+    try:
+        results = await asyncio.gather(*(_host(b, e["token"], SharedRequest(http), SharedRequest(polling),
+                                               gate, stop) for b, e in zip(bots, entries)),
+                                       return_exceptions=True)
+        for b, res in zip(bots, results):
+            if isinstance(res, Exception):
+                print(f"[{b.name}] stopped with an error: {res!r}")
+    finally:
+        await http.shutdown()
+        await polling.shutdown()
+        executor.shutdown(wait=True)
 
-    # Text input handler for awaited steps & simple fallback
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+def main():
+    bots_file = sys.argv[1] if len(sys.argv) > 1 else BOTS_FILE
+    if bots_file:
+        print(f"Hosting the bots listed in {bots_file}...")
+        asyncio.run(run_bots(bots_file))
+        return
+
+    application = build_application()
 
-    print("Bot is running... Keep Pydroid open.")
-    application.run_polling()
+    if WEBHOOK_URL:
+        print(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        )
+    else:
+        print("Bot is running... Keep Pydroid open.")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file